@@ -1,3 +1,4 @@
+import os
 import sys
 import importlib
 import asyncio
@@ -12,7 +13,7 @@ def perplexity_call():
 	
 def gpt_vert_call():
     from src.assign_vert import main
-    main()
+    return main()
 
 def url_cleaner():
 	from utils.clean_urls import main
@@ -24,11 +25,15 @@ def web_info_parser():
 
 def comp_type_classifier():
 	from src.company_type import main
-	main()
+	return main()
 
 def sub_vertical_classifier():
 	from src.sub_vertical import main
-	main()
+	return main()
+
+def streaming_classifier():
+	from src.pipeline import main
+	return main()
 
 def clear_error_sub_vertical():
 	from utils.reason_timeout import main
@@ -41,31 +46,44 @@ def vertical_score_all():
         print(f"{v}: {r[:120]}")  # just print first 120 chars
 
 
-if __name__ == '__main__':
+async def pipeline():
+	# Stages run strictly in order; each awaits the previous one's output CSV.
+	# Sync stages (some of which call asyncio.run themselves) run in a worker thread.
+
 	# Purpose: Cleans URLS to a homepage format since HubSpot websites are formatted inconsistently.
 	print('Running url_cleaner...')
-	url_cleaner()
+	await asyncio.to_thread(url_cleaner)
 	# Purpose: Calls Perplexity API to get website information.
 	print('Running website_info_perplexity...')
-	perplexity_call()
+	await asyncio.to_thread(perplexity_call)
 	# Purpose: For inputs that included all of the model reasoning given perpetual loop from a bad URL, turn these values to N/A.
 	print('Running bad_reason_cleaner...')
-	run_bad_reason_cleaner()
+	await asyncio.to_thread(run_bad_reason_cleaner)
 	# Purpose: Parse Website info for explicit categories.
 	print('Parsing Website Information...')
-	web_info_parser()
-	# Purpose: Calls GPT API to assign company type given the respective website Information that was pulled.
-	print('Assigning Company Type...')
-	comp_type_classifier()
-	# Purpose: Calls GPT API to assign verticals given the respective website Information that was pulled.
-	print('Assigning Verticals...')
-	gpt_vert_call()
-	# Purpose: Calls GPT API to assign sub-verticals given the respective website Information that was pulled.
-	print('Assigning Sub-Verticals...')
-	sub_vertical_classifier()
+	await asyncio.to_thread(web_info_parser)
+	if os.getenv('STREAMING_PIPELINE') == '1':
+		# Purpose: Company type -> vertical -> sub-vertical per row, all three stages running concurrently.
+		# All three columns are written to company_type.OUTPUT_CSV; sub_vertical.INPUT_CSV is not touched.
+		print('Assigning Company Type, Verticals and Sub-Verticals (streaming)...')
+		await streaming_classifier()
+	else:
+		# Purpose: Calls GPT API to assign company type given the respective website Information that was pulled.
+		print('Assigning Company Type...')
+		await comp_type_classifier()
+		# Purpose: Calls GPT API to assign verticals given the respective website Information that was pulled.
+		print('Assigning Verticals...')
+		await gpt_vert_call()
+		# Purpose: Calls GPT API to assign sub-verticals given the respective website Information that was pulled.
+		print('Assigning Sub-Verticals...')
+		await sub_vertical_classifier()
 	# Purpose: Clean Error Requests
 	print('Cleaning Sub-Verticals...')
-	clear_error_sub_vertical()
+	await asyncio.to_thread(clear_error_sub_vertical)
 	# purpose: Test Scoring for a single vertical.
 	print('Running scoring for all verticals...')
-	vertical_score_all()
\ No newline at end of file
+	await asyncio.to_thread(vertical_score_all)
+
+
+if __name__ == '__main__':
+	asyncio.run(pipeline())
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""
+Pieces shared by the GPT classification scripts (company_type, assign_vert,
+sub_vertical, scoring): the cached API call and the bounded worker pool.
+Improvements to either land in every script at once.
+"""
+
+import asyncio
+from src import llm_cache
+from src.openai_client import FATAL_ERRORS, create_response
+
+# cache key -> call in progress, so rows with identical prompts (boilerplate or
+# franchise pages) that are in flight at the same time share one API call
+_inflight = {}
+
+
+async def _fetch(client, model, prompt, key, timeout, attempts, params):
+    result = await create_response(client, timeout, attempts, model=model, input=prompt, **params)
+    output = (getattr(result, "output_text", None) or str(result)).strip()
+    await llm_cache.set(key, output)
+    return output
+
+
+async def cached_response(client, model, prompt, timeout, attempts, **params):
+    """Answer text for a prompt: from llm_cache, else one (retried) API call whose
+    answer is then cached. Concurrent callers with the same prompt await the same
+    call. Errors propagate; each script decides how to report them."""
+    key = llm_cache.cache_key(model, prompt)
+    cached = await llm_cache.get(key)
+    if cached is not None:
+        return cached
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(client, model, prompt, key, timeout, attempts, params))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded: one caller being cancelled must not cancel the call for the others
+    return await asyncio.shield(task)
+
+
+async def run_pool(items, process, concurrency, on_error):
+    """Await process(item) for every item on `concurrency` workers.
+
+    Items go through a bounded queue, so only O(concurrency) are pending at once.
+    FATAL_ERRORS cancel the whole pool (and the caller) via the TaskGroup; any other
+    exception is handed to on_error(item, exc) and the worker moves on.
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            try:
+                await process(item)
+            except FATAL_ERRORS:
+                raise
+            except Exception as e:
+                on_error(item, e)
+            finally:
+                queue.task_done()
+
+    async with asyncio.TaskGroup() as tg:
+        workers = [tg.create_task(worker()) for _ in range(concurrency)]
+        for item in items:
+            await queue.put(item)
+        await queue.join()
+        for w in workers:
+            w.cancel()
@@ -1,12 +1,17 @@
 import os
-import csv
 import pathlib
-import tempfile
+import hashlib
 import asyncio
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from src._classifier import cached_response, run_pool
+from src.csv_io import append_journal, iter_rows, load_journal, open_journal, write_csv_atomic
+from src.openai_batch import BATCH_MODE, prime_cache
+from src.openai_client import FATAL_ERRORS, get_client, warm_pool
+from src.progress_log import get_logger
+from src.prompt_render import compile_template, load_prompt, render
 
 load_dotenv()
+logger = get_logger(__name__)
 
 INPUT_CSV = 'data/net_new_web_info_company_type_parsed.csv'
 PROMPT_PATH = 'prompts/Vertical.txt'
@@ -14,140 +19,123 @@ INFO_COL = 'Website Information'
 VERTICAL_COL = 'Vertical'
 COMPANY_COL = 'COMPANY_NAME'
 URL_COL = 'URL'
+# Append-only checkpoint of completed rows; merged into INPUT_CSV once at the end
+JOURNAL_PATH = str(pathlib.Path(INPUT_CSV).with_suffix('.partial.jsonl'))
 CONCURRENCY = 10
 REQUEST_TIMEOUT = 45
-MAX_RETRIES = 3  # Number of retry attempts
+MAX_RETRIES = 5  # Attempts for transient API errors (see openai_client.create_response)
+
+# Prompt placeholder -> CSV column
+COL_MAP = {
+    'company name': COMPANY_COL,
+    'BUSINESS_MODEL': 'BUSINESS_MODEL',
+    'PRODUCTS': 'PRODUCTS',
+    'WEBSITE_FINDINGS': 'WEBSITE_FINDINGS',
+    'TARGET_CUSTOMERS': 'TARGET_CUSTOMERS',
+    'DISTRIBUTION FINDINGS': 'DISTRIBUTION FINDINGS',
+    'ADDITIONAL FINDINGS': 'ADDITIONAL FINDINGS',
+}
 
 async def classify_vertical(client, model, prompt, company_name=""):
     """Classify with automatic retries on failure."""
-    last_error = None
-    
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            coro = client.responses.create(model=model, input=prompt, reasoning={"effort": "high"})
-            result = await asyncio.wait_for(coro, timeout=REQUEST_TIMEOUT)
-            return (getattr(result, "output_text", None) or str(result)).strip()
-        
-        except asyncio.TimeoutError as e:
-            last_error = e
-            print(f"  ⚠️  Timeout on attempt {attempt}/{MAX_RETRIES} for {company_name}")
-            if attempt < MAX_RETRIES:
-                backoff = 2 ** (attempt - 1)  # 1s, 2s, 4s
-                await asyncio.sleep(backoff)
-        
-        except Exception as e:
-            last_error = e
-            print(f"  ⚠️  Error on attempt {attempt}/{MAX_RETRIES} for {company_name}: {type(e).__name__}: {e}")
-            if attempt < MAX_RETRIES:
-                backoff = 2 ** (attempt - 1)
-                await asyncio.sleep(backoff)
-    
-    # All retries exhausted
-    error_type = type(last_error).__name__ if last_error else "Unknown"
-    return f"ERROR after {MAX_RETRIES} attempts: {error_type}: {last_error}"
+    # Reasoning effort is fixed, so an identical prompt can reuse a cached answer
+    try:
+        return await cached_response(
+            client, model, prompt, REQUEST_TIMEOUT, MAX_RETRIES, reasoning={"effort": "high"})
+    except FATAL_ERRORS:
+        raise
+    except Exception as e:
+        logger.warning(f"  ⚠️  Giving up on {company_name}: {type(e).__name__}: {e}")
+        return f"ERROR: {type(e).__name__}: {e}"
 
 async def main_async():
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
-        print("ERROR: OPENAI_API_KEY not set in environment. Load your .env or set the env var.")
+        logger.error("ERROR: OPENAI_API_KEY not set in environment. Load your .env or set the env var.")
         return
 
-    client = AsyncOpenAI()
-    model = "gpt-5"
-
-    with open(PROMPT_PATH, 'r', encoding='utf-8') as f:
-        prompt_template = f.read()
-
-    with open(INPUT_CSV, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames or []
-        if VERTICAL_COL not in fieldnames:
-            fieldnames = fieldnames + [VERTICAL_COL]
-        rows = list(reader)
-
-    # Prepare rows to process
-    rows_to_process = []
-    for row in rows:
-        company_name = row.get(COMPANY_COL, '').strip()
-        company_type = row.get('Company Type', '').strip()
-        vertical_raw = row.get(VERTICAL_COL)
-
-        if vertical_raw and vertical_raw.strip():
-            continue
-        if company_type not in ('Distributor', 'Both'):
-            continue
-        rows_to_process.append(row)
-
-    print(f"{len(rows_to_process)} rows will be processed (not skipped).")
-
-    SEMAPHORE = asyncio.Semaphore(CONCURRENCY)
-    file_lock = asyncio.Lock()  # Add lock for thread-safe file writing
-
-    async def process_row(row, idx):
-        business_model = row.get('BUSINESS_MODEL', '').strip()
-        products = row.get('PRODUCTS', '').strip()
-        website_findings = row.get('WEBSITE_FINDINGS', '').strip()
-        target_customers = row.get('TARGET_CUSTOMERS', '').strip()
-        distribution_findings = row.get('DISTRIBUTION FINDINGS', '').strip()
-        additional_info = row.get('ADDITIONAL FINDINGS', '').strip()
-
-        prompt = prompt_template
-        prompt = prompt.replace('{company name}', row.get(COMPANY_COL, '').strip())
-        prompt = prompt.replace('{BUSINESS_MODEL}', business_model)
-        prompt = prompt.replace('{PRODUCTS}', products)
-        prompt = prompt.replace('{WEBSITE_FINDINGS}', website_findings)
-        prompt = prompt.replace('{TARGET_CUSTOMERS}', target_customers)
-        prompt = prompt.replace('{DISTRIBUTION FINDINGS}', distribution_findings)
-        prompt = prompt.replace('{ADDITIONAL FINDINGS}', additional_info)
-
-        company_name = row.get(COMPANY_COL, '').strip()
-        output = await classify_vertical(client, model, prompt, company_name)
-        row[VERTICAL_COL] = output
-        print(f"[{idx+1}/{len(rows_to_process)}] {row.get(COMPANY_COL,'')}: {output[:120]}")
-        
-        # Save progress after each result
-        # Use URL as unique identifier instead of company name
-        url = row.get(URL_COL, '').strip()
-        async with file_lock:  # Protect file writes from concurrent access
-            for r in rows:
-                if r.get(URL_COL, '').strip() == url:
-                    r[VERTICAL_COL] = output
-                    break
-            tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_', suffix='.csv', dir=str(pathlib.Path(INPUT_CSV).parent))
-            os.close(tmp_fd)
-            with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(rows)
-            os.replace(tmp_path, INPUT_CSV)
-        return row
-
-    async def sem_task(row, idx):
-        async with SEMAPHORE:
-            return await process_row(row, idx)
-
-    tasks = [asyncio.create_task(sem_task(row, i)) for i, row in enumerate(rows_to_process)]
-    gathered = await asyncio.gather(*tasks, return_exceptions=True)
-
-    # Merge results back into original row list
-    processed_map = {r.get(URL_COL, '').strip(): r for r in gathered if isinstance(r, dict)}
-    final_rows = []
-    for row in rows:
-        url = row.get(URL_COL, '').strip()
-        if url in processed_map:
-            final_rows.append(processed_map[url])
-        else:
-            final_rows.append(row)
-
-    tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_', suffix='.csv', dir=str(pathlib.Path(INPUT_CSV).parent))
-    os.close(tmp_fd)
-    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(final_rows)
-    os.replace(tmp_path, INPUT_CSV)
-
-    print("Completed processing with concurrency.")
+    async with get_client(CONCURRENCY, REQUEST_TIMEOUT) as client:
+        model = "gpt-5"
+
+        # Compiled once; static instructions stay a byte-identical prefix for every row
+        compiled_prompt = compile_template(load_prompt(PROMPT_PATH), COL_MAP)
+
+        # Resume support: results journaled by a previous, interrupted run (keyed by URL)
+        existing_results = {e['url']: e[VERTICAL_COL] for e in load_journal(JOURNAL_PATH)}
+
+        # Read and pre-filter in a single streaming pass over the CSV
+        rows = []
+        rows_to_process = []
+        prepared = []  # stripped prompt values, parallel to rows_to_process
+        with open(INPUT_CSV, newline='', encoding='utf-8') as f:
+            fieldnames, reader = iter_rows(f, extra_cols=(VERTICAL_COL,))
+            for row in reader:
+                rows.append(row)
+                vertical_raw = row.get(VERTICAL_COL)
+                if vertical_raw and vertical_raw.strip():
+                    continue
+                url = row.get(URL_COL, '').strip()
+                if url in existing_results:
+                    row[VERTICAL_COL] = existing_results[url]
+                    continue
+                if row.get('Company Type', '').strip() not in ('Distributor', 'Both'):
+                    continue
+                rows_to_process.append(row)
+                prepared.append({var: row.get(col, '').strip() for var, col in COL_MAP.items()})
+
+        logger.info(f"{len(rows_to_process)} rows will be processed (not skipped). Resumed from journal: {len(existing_results)}")
+
+        # Each result is one flushed line; no lock, rename or fsync needed per row
+        journal = open_journal(JOURNAL_PATH)
+
+        # Rows rendering byte-identical prompts (e.g. franchise/branch entries) are sent
+        # once; the answer is fanned out to every row in the group
+        groups = {}
+        for row, values in zip(rows_to_process, prepared):
+            prompt = render(compiled_prompt, values)
+            h = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+            groups.setdefault(h, (prompt, values['company name'], []))[2].append(row)
+        if len(groups) < len(rows_to_process):
+            logger.info(f"{len(groups)} distinct prompts after de-duplication.")
+
+        if BATCH_MODE:
+            prompts = [prompt for prompt, _, _ in groups.values()]
+            await prime_cache(client, model, prompts, reasoning={"effort": "high"})
+
+        async def process_group(prompt, company_name, members, idx):
+            output = await classify_vertical(client, model, prompt, company_name)
+            dupes = f" (+{len(members) - 1} identical)" if len(members) > 1 else ""
+            logger.info(f"[{idx+1}/{len(groups)}] {company_name}{dupes}: {output[:120]}")
+
+            for row in members:
+                row[VERTICAL_COL] = output
+                # Journal the result (keyed by URL) instead of rewriting the whole CSV
+                url = row.get(URL_COL, '').strip()
+                if url:
+                    append_journal(journal, {'url': url, VERTICAL_COL: output})
+
+        def report_error(item, e):
+            logger.warning(f"Row {item[3]} error: {type(e).__name__}: {e}")
+
+        await warm_pool(client, CONCURRENCY)
+
+        # CONCURRENCY workers pull from a bounded queue; a fatal error cancels the run
+        try:
+            await run_pool(
+                ((prompt, name, members, i) for i, (prompt, name, members) in enumerate(groups.values())),
+                lambda item: process_group(*item),
+                CONCURRENCY,
+                report_error,
+            )
+        finally:
+            journal.close()
+
+        # process_group fills in the row dicts in place, so `rows` already holds every result
+        await asyncio.to_thread(write_csv_atomic, INPUT_CSV, fieldnames, rows)
+        # Everything in the journal is now in INPUT_CSV
+        os.remove(JOURNAL_PATH)
+
+        logger.info("Completed processing with concurrency.")
 
 def main():
     try:
@@ -156,8 +144,8 @@ def main():
         loop = None
 
     if loop and loop.is_running():
-        print("Detected running event loop — scheduling processing as a background task.")
-        return asyncio.create_task(main_async())
+        # Hand the coroutine back so the async caller awaits it (see main.pipeline)
+        return main_async()
     else:
         return asyncio.run(main_async())
 
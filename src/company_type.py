@@ -1,20 +1,32 @@
 import os
-import csv
+import json
+import queue
 import pathlib
+import hashlib
 import tempfile
 import asyncio
+import openai
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from src._classifier import cached_response
+from src.csv_io import atomic_csv_writer, iter_rows
+from src.openai_batch import BATCH_MODE, prime_cache
+from src.openai_client import FATAL_ERRORS, get_client, warm_pool
+from src.progress_log import get_logger
+from src.prompt_render import compile_template, load_prompt, render
 
 load_dotenv()
+logger = get_logger(__name__)
 
 # ---------- CONFIG ----------
 INPUT_CSV = 'data/net_new_web_info_parsed.csv'
 PROMPT_PATH = 'prompts/company_type.txt'
 OUTPUT_CSV = 'data/net_new_web_info_company_type_parsed.csv'
 COMPANY_TYPE_COL = 'Company Type'
+# Sidecar cache: hash of the row's prompt inputs (excluding the name) -> company type
+TYPE_CACHE_PATH = 'data/company_type_cache.json'
 CONCURRENCY = 10
 REQUEST_TIMEOUT = 60
+MAX_RETRIES = 5  # attempts for transient API errors (429/5xx/connection/timeout)
 # ----------------------------
 
 # Columns to map to prompt variables (CSV header casing matters)
@@ -30,154 +42,226 @@ COL_MAP = {
 }
 
 
-async def classify_company(client, model, prompt):
-    """Call the API with a timeout and return result or error string."""
-    try:
-        coro = client.responses.create(
-            model=model,
-            input=prompt,
-            reasoning={"effort": "high"}
-        )
-        result = await asyncio.wait_for(coro, timeout=REQUEST_TIMEOUT)
-        return (getattr(result, "output_text", None) or str(result)).strip()
-    except asyncio.TimeoutError:
-        return "ERROR: timeout"
-    except Exception as e:
-        return f"ERROR: {e}"
+def has_business_model(row):
+    """Rows whose business model is truly missing are not worth classifying."""
+    return row.get('BUSINESS_MODEL', '').strip() not in ('', 'Not specified', 'N/A')
 
 
-async def main_async():
-    # ---- Env check ----
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        print("ERROR: OPENAI_API_KEY not set.")
-        return
+def prepare_values(row):
+    """Stripped prompt values for a row; 'N/A' renders as blank."""
+    values = {}
+    for var, col in COL_MAP.items():
+        value = row.get(col, "").strip()
+        values[var] = "" if value.upper() == "N/A" else value
+    return values
 
-    client = AsyncOpenAI()
-    model = "gpt-5"
 
-    # ---- Load prompt ----
-    try:
-        with open(PROMPT_PATH, 'r', encoding='utf-8') as f:
-            prompt_template = f.read()
-    except FileNotFoundError:
-        print(f"ERROR: Prompt file not found at {PROMPT_PATH}")
-        return
+def content_key(values):
+    """Hash the prompt inputs other than the company name, so renamed or duplicate
+    companies with identical website content share one classification."""
+    content = tuple(v for var, v in values.items() if var != 'company_name')
+    return hashlib.sha256(repr(content).encode('utf-8')).hexdigest()
+
 
-    # ---- Load existing output (resume support) using URL as key ----
-    existing_types = {}
-    output_path = pathlib.Path(OUTPUT_CSV)
-    if output_path.exists():
-        with open(output_path, newline='', encoding='utf-8') as outf:
-            reader = csv.DictReader(outf)
-            for r in reader:
-                url = r.get('URL', '').strip()
-                val = r.get(COMPANY_TYPE_COL, '').strip()
-                if url and val:
-                    existing_types[url] = val
-
-    # ---- Read input CSV ----
+def load_type_cache():
     try:
-        with open(INPUT_CSV, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-            fieldnames = reader.fieldnames or []
-            if COMPANY_TYPE_COL not in fieldnames:
-                fieldnames = fieldnames + [COMPANY_TYPE_COL]
-    except FileNotFoundError:
-        print(f"ERROR: Input CSV not found at {INPUT_CSV}")
-        return
+        with open(TYPE_CACHE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_type_cache(cache):
+    cache_path = pathlib.Path(TYPE_CACHE_PATH)
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_', suffix='.json', dir=str(cache_path.parent))
+    with os.fdopen(tmp_fd, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, str(cache_path))
+
+
+def pending_prompts(compiled_prompt, existing_types, types_by_hash):
+    """Prompts the live pass will send (one per distinct content), for batch mode."""
+    prompts = {}
+    with open(INPUT_CSV, newline='', encoding='utf-8') as f:
+        _, reader = iter_rows(f)
+        for row in reader:
+            if row.get('URL', '').strip() in existing_types or not has_business_model(row):
+                continue
+            values = prepare_values(row)
+            key = content_key(values)
+            if key not in types_by_hash and key not in prompts:
+                prompts[key] = render(compiled_prompt, values)
+    return list(prompts.values())
 
-    print(f"Read {len(rows)} rows. Existing classified: {len(existing_types)}")
 
-    # ---- Decide what to process ----
-    rows_to_process = []
-    for row in rows:
-        url = row.get('URL', '').strip()
-        company_name = row.get('Company Name', '').strip()
-        business_model = row.get('BUSINESS_MODEL', '').strip()
+async def classify_company(client, model, prompt):
+    """Call the API with a timeout and retries; return result or error string."""
+    try:
+        return await cached_response(
+            client, model, prompt, REQUEST_TIMEOUT, MAX_RETRIES, reasoning={"effort": "high"})
+    except FATAL_ERRORS:
+        raise
+    except openai.APITimeoutError:
+        return "ERROR: timeout"
+    except Exception as e:
+        return f"ERROR: {e}"
 
-        # Resume: already classified
-        if url in existing_types:
-            row[COMPANY_TYPE_COL] = existing_types[url]
-            continue
 
-        # Skip only if business model is truly missing
-        if business_model in ('', 'Not specified', 'N/A'):
-            row[COMPANY_TYPE_COL] = ''
-            continue
+# Put on the writer thread's queue in place of None to drop the output instead of committing it
+_DISCARD = object()
 
-        # Company Name may be N/A — that is OK
-        rows_to_process.append(row)
 
-    print(f"{len(rows_to_process)} rows will be processed.")
+def write_output(fieldnames, rows):
+    """Writer thread for main_async: write each row put on `rows` (a SimpleQueue) to
+    OUTPUT_CSV, and commit the file when None arrives. Buffer flushes, the fsync and
+    the rename all happen here, off the event loop."""
+    with atomic_csv_writer(OUTPUT_CSV, fieldnames) as writer:
+        while (row := rows.get()) is not None:
+            if row is _DISCARD:
+                raise RuntimeError(f"{OUTPUT_CSV} not written: the run failed")
+            writer.writerow(row)
 
-    if not rows_to_process:
-        with open(OUTPUT_CSV, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(rows)
-        print("No rows to process. Output written.")
+
+async def main_async():
+    # ---- Env check ----
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        logger.error("ERROR: OPENAI_API_KEY not set.")
         return
 
-    SEMAPHORE = asyncio.Semaphore(CONCURRENCY)
-
-    async def process_row(row, idx):
-        prompt = prompt_template
-        for var, col in COL_MAP.items():
-            value = row.get(col, "")
-            if value.strip().upper() == "N/A":
-                value = ""
-            prompt = prompt.replace(f'{{{var}}}', value.strip())
-
-        output = await classify_company(client, model, prompt)
-        row[COMPANY_TYPE_COL] = output
-
-        display_name = row.get('Company Name', '').strip()
-        if not display_name or display_name.upper() == 'N/A':
-            display_name = row.get('URL', '')
-
-        print(f"[{idx+1}/{len(rows_to_process)}] {display_name}: {output[:120]}")
-        return row
-
-    async def sem_task(row, idx):
-        async with SEMAPHORE:
-            return await process_row(row, idx)
-
-    tasks = [asyncio.create_task(sem_task(row, i)) for i, row in enumerate(rows_to_process)]
-    gathered = await asyncio.gather(*tasks, return_exceptions=True)
-
-    results = []
-    for i, item in enumerate(gathered):
-        if isinstance(item, Exception):
-            r = rows_to_process[i]
-            r[COMPANY_TYPE_COL] = f"ERROR: {item}"
-            results.append(r)
-            print(f"Task {i} error: {item}")
-        else:
-            results.append(item)
-
-    # ---- Merge results back using URL ----
-    processed_map = {r.get('URL', '').strip(): r for r in results}
-    final_rows = []
-    for row in rows:
-        url = row.get('URL', '').strip()
-        final_rows.append(processed_map.get(url, row))
-
-    # ---- Atomic write ----
-    tmp_fd, tmp_path = tempfile.mkstemp(
-        prefix='tmp_', suffix='.csv',
-        dir=str(pathlib.Path(OUTPUT_CSV).parent)
-    )
-    os.close(tmp_fd)
-
-    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(final_rows)
-
-    os.replace(tmp_path, OUTPUT_CSV)
-    print("Completed processing.")
+    async with get_client(CONCURRENCY, REQUEST_TIMEOUT) as client:
+        model = "gpt-5"
+
+        # ---- Load prompt ----
+        try:
+            prompt_template = load_prompt(PROMPT_PATH)
+        except FileNotFoundError:
+            logger.error(f"ERROR: Prompt file not found at {PROMPT_PATH}")
+            return
+        # Compiled once; static instructions stay a byte-identical prefix for every row
+        compiled_prompt = compile_template(prompt_template, COL_MAP)
+
+        # ---- Load existing output (resume support) using URL as key ----
+        existing_types = {}
+        output_path = pathlib.Path(OUTPUT_CSV)
+        if output_path.exists():
+            with open(output_path, newline='', encoding='utf-8') as outf:
+                _, reader = iter_rows(outf)
+                for r in reader:
+                    url = r.get('URL', '').strip()
+                    val = r.get(COMPANY_TYPE_COL, '').strip()
+                    if url and val:
+                        existing_types[url] = val
+        existing_types_by_hash = load_type_cache()
+
+        if not os.path.exists(INPUT_CSV):
+            logger.error(f"ERROR: Input CSV not found at {INPUT_CSV}")
+            return
+
+        if BATCH_MODE:
+            prompts = pending_prompts(compiled_prompt, existing_types, existing_types_by_hash)
+            await prime_cache(client, model, prompts, reasoning={"effort": "high"})
+
+        in_queue = asyncio.Queue(maxsize=CONCURRENCY * 4)
+        out_queue = asyncio.Queue(maxsize=CONCURRENCY * 4)
+        counts = {'read': 0, 'resumed': 0, 'classified': 0}
+
+        # content hash -> classification in progress, so duplicate (e.g. franchise/branch)
+        # rows in flight together share one call even when their names differ. Entries
+        # are dropped once the call settles, so an ERROR is never handed to a later row.
+        inflight = {}
+
+        async def classify_row(row):
+            values = prepare_values(row)
+            key = content_key(values)
+            # Same inputs as a row classified in a previous run?
+            output = existing_types_by_hash.get(key)
+            if output is None:
+                task = inflight.get(key)
+                if task is None:
+                    task = asyncio.ensure_future(classify_company(client, model, render(compiled_prompt, values)))
+                    inflight[key] = task
+                    task.add_done_callback(lambda _: inflight.pop(key, None))
+                # Shielded: one row being cancelled must not cancel the call for the others
+                output = await asyncio.shield(task)
+                if not output.startswith('ERROR'):
+                    existing_types_by_hash[key] = output
+            counts['classified'] += 1
+            display_name = values['company_name'] or row.get('URL', '')
+            logger.info(f"[{counts['classified']}] {display_name}: {output[:120]}")
+            return output
+
+        async def worker():
+            while True:
+                seq, row = await in_queue.get()
+                try:
+                    row[COMPANY_TYPE_COL] = await classify_row(row)
+                except FATAL_ERRORS:
+                    raise
+                except Exception as e:
+                    row[COMPANY_TYPE_COL] = f"ERROR: {e}"
+                    logger.warning(f"Row {seq} error: {e}")
+                await out_queue.put((seq, row))
+                in_queue.task_done()
+
+        async def write_in_order(rows_out):
+            # Rows finish out of order; buffer them until the next one in input order is
+            # in, then hand them to the writer thread
+            pending = {}
+            next_seq = 0
+            while (item := await out_queue.get()) is not None:
+                seq, row = item
+                pending[seq] = row
+                while next_seq in pending:
+                    rows_out.put(pending.pop(next_seq))
+                    next_seq += 1
+
+        await warm_pool(client, CONCURRENCY)
+
+        # ---- Stream input -> CONCURRENCY workers -> ordering -> writer thread ----
+        # Only O(CONCURRENCY) rows are held at once (plus any finished rows waiting
+        # on a slower earlier row, or on the disk), instead of the whole file.
+        # TaskGroup: a fatal error in any worker cancels the others, the producer and
+        # the writer; the temp file is then discarded and OUTPUT_CSV is left as it was
+        with open(INPUT_CSV, newline='', encoding='utf-8') as f:
+            fieldnames, reader = iter_rows(f, extra_cols=(COMPANY_TYPE_COL,))
+            rows_out = queue.SimpleQueue()
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(asyncio.to_thread(write_output, fieldnames, rows_out))
+                    order_task = tg.create_task(write_in_order(rows_out))
+                    workers = [tg.create_task(worker()) for _ in range(CONCURRENCY)]
+                    for seq, row in enumerate(reader):
+                        counts['read'] += 1
+                        url = row.get('URL', '').strip()
+                        if url in existing_types:
+                            # Resume: already classified
+                            row[COMPANY_TYPE_COL] = existing_types[url]
+                            counts['resumed'] += 1
+                            await out_queue.put((seq, row))
+                        elif not has_business_model(row):
+                            # Skip only if business model is truly missing
+                            row[COMPANY_TYPE_COL] = ''
+                            await out_queue.put((seq, row))
+                        else:
+                            # Company Name may be N/A — that is OK
+                            await in_queue.put((seq, row))
+                    await in_queue.join()
+                    await out_queue.put(None)
+                    await order_task
+                    rows_out.put(None)  # commit; the TaskGroup waits for the thread
+                    for w in workers:
+                        w.cancel()
+            except BaseException:
+                # The writer thread isn't cancelled with its task; stop it so it
+                # deletes the temp file
+                rows_out.put(_DISCARD)
+                raise
+
+        logger.info(f"Read {counts['read']} rows. Existing classified: {counts['resumed']}. "
+                    f"Classified this run: {counts['classified']}")
+        await asyncio.to_thread(save_type_cache, existing_types_by_hash)
+        logger.info("Completed processing.")
 
 
 def main():
@@ -187,8 +271,8 @@ def main():
         loop = None
 
     if loop and loop.is_running():
-        print("Detected running event loop — scheduling task.")
-        return asyncio.create_task(main_async())
+        # Hand the coroutine back so the async caller awaits it (see main.pipeline)
+        return main_async()
     else:
         return asyncio.run(main_async())
 
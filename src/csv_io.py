@@ -0,0 +1,180 @@
+import os
+import csv
+import ctypes
+import pathlib
+import contextlib
+import tempfile
+import orjson
+
+# Perplexity answers can be far longer than csv's default 128 KiB field limit. Every
+# script reads through this module, so the limit is raised once here, to the largest
+# value the C long behind it holds (2**31 - 1 on Windows, where long is 32-bit).
+csv.field_size_limit(ctypes.c_ulong(-1).value // 2)
+
+# Output files are written through a 1 MiB buffer: rows with multi-KB Website
+# Information cells would otherwise cost a write syscall every 8 KiB.
+WRITE_BUFFER = 1 << 20
+
+
+class Row:
+    """One CSV row: a list of cells plus a column index shared by every row.
+
+    Much lighter than DictReader's dict-per-row, but supports the mapping methods the
+    scripts use (get, [], keys), so existing row code works unchanged.
+    """
+    __slots__ = ('cells', 'index')
+
+    def __init__(self, cells, index):
+        self.cells = cells
+        self.index = index
+
+    def get(self, col, default=None):
+        i = self.index.get(col)
+        if i is None or i >= len(self.cells):
+            return default
+        return self.cells[i]
+
+    def __getitem__(self, col):
+        i = self.index[col]
+        return self.cells[i] if i < len(self.cells) else ''
+
+    def __setitem__(self, col, value):
+        i = self.index[col]
+        if i >= len(self.cells):
+            self.cells.extend([''] * (i + 1 - len(self.cells)))
+        self.cells[i] = value
+
+    def keys(self):
+        return self.index.keys()
+
+
+def iter_rows(f, extra_cols=()):
+    """Read an open CSV file as Row objects.
+
+    Returns (fieldnames, rows iterator); fieldnames is the header plus any of
+    `extra_cols` it lacks. Short rows are padded with '' to the full width, so
+    assigning a column never resizes a row's cells (a checkpoint may be writing
+    them from another thread).
+    """
+    reader = csv.reader(f)
+    header = next(reader, [])
+    fieldnames = header + [c for c in dict.fromkeys(extra_cols) if c not in header]
+    index = {name: i for i, name in enumerate(fieldnames)}
+    return fieldnames, _padded_rows(reader, index, len(fieldnames))
+
+
+def _padded_rows(reader, index, width):
+    for cells in reader:
+        if not cells:
+            continue
+        if len(cells) < width:
+            cells.extend([''] * (width - len(cells)))
+        yield Row(cells, index)
+
+
+class RowWriter:
+    """csv.writer with DictWriter's writerow/writerows for a fixed list of fieldnames.
+
+    Rows whose columns are already in fieldnames order are written positionally with
+    no per-field lookups: Row objects read with this same header (their cells, padded
+    to width) and plain lists/tuples. Anything else (e.g. a dict) is looked up by
+    fieldname, with '' for missing keys.
+    """
+
+    def __init__(self, f, fieldnames):
+        self.fieldnames = list(fieldnames)
+        self._writer = csv.writer(f)
+        self._width = len(self.fieldnames)
+        self._index = None  # last Row index seen to match fieldnames
+
+    def writeheader(self):
+        self._writer.writerow(self.fieldnames)
+
+    def _cells(self, row):
+        if isinstance(row, (list, tuple)):
+            return row
+        if isinstance(row, Row):
+            if row.index is not self._index and list(row.index) == self.fieldnames:
+                self._index = row.index
+            if row.index is self._index:
+                cells = row.cells
+                if len(cells) == self._width:
+                    return cells
+                return (cells + [''] * self._width)[:self._width]
+        return [row.get(f, '') for f in self.fieldnames]
+
+    def writerow(self, row):
+        return self._writer.writerow(self._cells(row))
+
+    def writerows(self, rows):
+        self._writer.writerows(map(self._cells, rows))
+
+
+@contextlib.contextmanager
+def atomic_csv_writer(path, fieldnames, prefix='tmp_'):
+    """Yield a RowWriter (header written) on a temp file next to `path`.
+
+    On a clean exit the temp file is fsync'd and os.replace'd into place; on an
+    error it is deleted and `path` is left untouched. Lets a caller stream rows
+    out as they finish instead of holding them all for write_csv_atomic.
+    """
+    path = pathlib.Path(path)
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=prefix, suffix='.csv', dir=str(path.parent))
+    try:
+        with open(tmp_fd, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER) as f:
+            writer = RowWriter(f, fieldnames)
+            writer.writeheader()
+            yield writer
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, str(path))
+    # Persist the rename itself (not possible on Windows, where directories can't be opened)
+    try:
+        dir_fd = os.open(str(path.parent), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_csv_atomic(path, fieldnames, rows, prefix='tmp_'):
+    """Write rows to a temp file next to `path`, fsync it, then os.replace it into place.
+
+    Blocking; call it from async code as `await asyncio.to_thread(write_csv_atomic, ...)`
+    so a multi-MB write doesn't stall in-flight API requests.
+    """
+    with atomic_csv_writer(path, fieldnames, prefix) as writer:
+        writer.writerows(rows)
+
+
+# ---- Append-only JSONL journal for per-row progress ----
+# Intermediate checkpoints can be regenerated, so they skip the temp file/rename/fsync
+# dance above: one handle stays open and each result is a single flushed line.
+# Lines are serialized with orjson straight to bytes; csv is only used for the final file.
+
+def open_journal(path):
+    return open(path, 'ab')
+
+
+def append_journal(fh, entry):
+    fh.write(orjson.dumps(entry) + b'\n')
+    fh.flush()
+
+
+def load_journal(path):
+    """Return all entries in a journal ([] if missing), skipping a torn last line."""
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                entries.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue
+    return entries
@@ -0,0 +1,66 @@
+"""
+Local disk cache for GPT responses, keyed by a SHA-256 of (model, rendered prompt).
+Re-runs that resubmit an identical prompt get the stored answer instead of a new
+gpt-5 call. Only successful responses are stored; callers never cache "ERROR" strings.
+"""
+
+import os
+import time
+import pathlib
+import sqlite3
+import hashlib
+import asyncio
+import threading
+
+CACHE_PATH = os.getenv('LLM_CACHE_PATH', '.cache/llm.sqlite3')
+
+_conn = None
+_lock = threading.Lock()
+
+
+def cache_key(model, prompt):
+    return hashlib.sha256(f"{model}\0{prompt}".encode('utf-8')).hexdigest()
+
+
+def _connect():
+    global _conn
+    if _conn is None:
+        pathlib.Path(CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)'
+        )
+    return _conn
+
+
+def _get_sync(key):
+    with _lock:
+        row = _connect().execute(
+            'SELECT value, expires FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+    if row is None:
+        return None
+    value, expires = row
+    if expires is not None and expires < time.time():
+        return None
+    return value
+
+
+def _set_sync(key, value, ttl):
+    expires = time.time() + ttl if ttl else None
+    with _lock:
+        conn = _connect()
+        conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, value, expires))
+        conn.commit()
+
+
+async def get(key):
+    """Return the cached response for key, or None on a miss/expired entry."""
+    return await asyncio.to_thread(_get_sync, key)
+
+
+async def set(key, value, ttl=None):
+    """Store value under key; ttl in seconds (None = never expires)."""
+    await asyncio.to_thread(_set_sync, key, value, ttl)
@@ -0,0 +1,134 @@
+"""
+OpenAI Batch API mode for non-interactive runs (pass --batch or set OPENAI_BATCH=1).
+
+Batch jobs cost half as much as live calls and are not subject to the account's
+RPM/TPM limits. Each script collects the prompts it is about to send and calls
+prime_cache() first: prompts not already in llm_cache are uploaded as JSONL
+batches (split to fit the Batch API's per-file request and size limits), and once
+the jobs complete every answer is stored in llm_cache. The script's normal live
+pass then finds each prompt cached and makes no API calls, except for prompts a
+batch failed on or could not take, which are sent live as usual.
+"""
+
+import os
+import sys
+import asyncio
+import openai
+import orjson
+from src import llm_cache
+from src.openai_client import FATAL_ERRORS
+from src.progress_log import get_logger
+
+logger = get_logger(__name__)
+
+BATCH_MODE = '--batch' in sys.argv[1:] or os.getenv('OPENAI_BATCH') == '1'
+POLL_SECONDS = int(os.getenv('OPENAI_BATCH_POLL_SECONDS', '30'))
+_DONE = ('completed', 'failed', 'expired', 'cancelled')
+# Batch API limits per input file: 50,000 requests and 200 MB. Larger inputs are
+# split across several batches; the byte cap leaves headroom under the 200 MB.
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+
+def _output_text(body):
+    """Same text as the SDK's Response.output_text, from the raw JSON body."""
+    return ''.join(
+        part.get('text', '')
+        for item in body.get('output') or []
+        if item.get('type') == 'message'
+        for part in item.get('content') or []
+        if part.get('type') == 'output_text'
+    ).strip()
+
+
+def _chunks(lines):
+    """Group JSONL request lines into batch input files within the Batch API's limits."""
+    chunk, size = [], 0
+    for line in lines:
+        if chunk and (len(chunk) >= MAX_BATCH_REQUESTS or size + len(line) > MAX_BATCH_BYTES):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield chunk
+
+
+async def _run_batch(client, lines):
+    """Submit one batch input file, wait for the job and cache its answers.
+
+    Returns the number of answers stored. A batch that can't be submitted (other
+    than for FATAL_ERRORS) or that doesn't complete stores nothing; its prompts
+    are then sent live.
+    """
+    try:
+        batch_file = await client.files.create(file=('batch.jsonl', b''.join(lines)), purpose='batch')
+        batch = await client.batches.create(
+            input_file_id=batch_file.id, endpoint='/v1/responses', completion_window='24h')
+    except FATAL_ERRORS:
+        raise
+    except openai.APIError as e:
+        logger.warning(f"WARNING: could not submit a batch of {len(lines)} prompts ({e}); sending them live.")
+        return 0
+    logger.info(f"Batch mode: submitted {len(lines)} prompts as batch {batch.id}")
+
+    while batch.status not in _DONE:
+        await asyncio.sleep(POLL_SECONDS)
+        batch = await client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        if counts:
+            logger.info(f"Batch {batch.id}: {batch.status} ({counts.completed}/{counts.total} done)")
+
+    if batch.status != 'completed' or not batch.output_file_id:
+        logger.warning(f"WARNING: batch {batch.id} ended as {batch.status}; falling back to live calls.")
+        return 0
+
+    content = await client.files.content(batch.output_file_id)
+    stored = 0
+    for line in content.content.splitlines():
+        if not line.strip():
+            continue
+        entry = orjson.loads(line)
+        response = entry.get('response') or {}
+        if response.get('status_code') != 200:
+            continue
+        output = _output_text(response.get('body') or {})
+        if output:
+            await llm_cache.set(entry['custom_id'], output)
+            stored += 1
+    return stored
+
+
+async def prime_cache(client, model, prompts, **params):
+    """Run every uncached prompt through Batch jobs and store the answers in llm_cache.
+
+    `params` are the extra responses.create arguments the live call uses
+    (e.g. reasoning={"effort": "high"}), so both paths send identical requests.
+    """
+    pending = {}
+    for prompt in prompts:
+        key = llm_cache.cache_key(model, prompt)
+        if key not in pending and await llm_cache.get(key) is None:
+            pending[key] = prompt
+    if not pending:
+        logger.info("Batch mode: every prompt is already cached.")
+        return
+
+    # custom_id is the cache key, so results land straight in llm_cache
+    lines = []
+    for key, prompt in pending.items():
+        line = orjson.dumps({
+            'custom_id': key,
+            'method': 'POST',
+            'url': '/v1/responses',
+            'body': {'model': model, 'input': prompt, **params},
+        }) + b'\n'
+        if len(line) > MAX_BATCH_BYTES:
+            continue  # too large for any batch file; the live pass sends it
+        lines.append(line)
+
+    # The jobs run side by side, so the wait is the slowest batch rather than the sum
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(_run_batch(client, chunk)) for chunk in _chunks(lines)]
+    stored = sum(t.result() for t in tasks)
+    logger.info(f"Batch mode: cached {stored}/{len(pending)} answers; the rest will be sent live.")
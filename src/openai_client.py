@@ -0,0 +1,173 @@
+import os
+import re
+import time
+import random
+import asyncio
+import contextlib
+import httpx
+import openai
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI
+from src.progress_log import get_logger
+
+logger = get_logger(__name__)
+
+# Requests- and tokens-per-minute budget for the OpenAI account. CONCURRENCY only
+# caps in-flight requests; these spread them out so bursts don't trip 429s.
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '500000'))
+
+# e.g. "6m0s", "1.5s", "120ms" in x-ratelimit-reset-* headers
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_SECONDS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def _parse_reset(value):
+    return sum(float(n) * _SECONDS[unit] for n, unit in _DURATION_RE.findall(value or ''))
+
+
+class CreditLimiter:
+    """Rolling per-minute request and token budgets, corrected by the server's headers.
+
+    Each call takes one request credit plus its estimated tokens. After a response,
+    update() reads x-ratelimit-remaining-*: if the account is (nearly) out of either
+    budget, new calls wait until the matching x-ratelimit-reset-* has passed.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.requests = AsyncLimiter(max_rate=rpm, time_period=60)
+        self.tokens = AsyncLimiter(max_rate=tpm, time_period=60)
+        self._paused_until = 0.0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, est_tokens):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.requests.acquire()
+        await self.tokens.acquire(min(max(est_tokens, 1), self.tokens.max_rate))
+        yield
+
+    def update(self, headers, est_tokens):
+        for kind, low_water in (('requests', 1), ('tokens', est_tokens)):
+            try:
+                remaining = int(headers.get(f'x-ratelimit-remaining-{kind}'))
+            except (TypeError, ValueError):
+                continue
+            if remaining < low_water:
+                reset = _parse_reset(headers.get(f'x-ratelimit-reset-{kind}'))
+                self._paused_until = max(self._paused_until, time.monotonic() + reset)
+
+
+CREDITS = CreditLimiter(OPENAI_RPM, OPENAI_TPM)
+
+# Transient failures (429, 5xx, dropped connections, timeouts) are retried with
+# full-jitter exponential backoff: sleep uniform(0, min(RETRY_MAX_DELAY, 2**attempt)).
+RETRY_ATTEMPTS = int(os.getenv('OPENAI_RETRY_ATTEMPTS', '5'))
+RETRY_MAX_DELAY = 30
+
+
+def is_transient(exc):
+    # APIConnectionError includes APITimeoutError (httpx connect/read/pool timeouts)
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError, httpx.RemoteProtocolError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+# Opt-in streamed responses (OPENAI_STREAM=1). The httpx read timeout then bounds the
+# gap between events rather than the whole reply, so a long answer that is still
+# arriving isn't killed and retried. The classifiers' one-word answers gain little,
+# so it is off by default.
+STREAM_RESPONSES = os.getenv('OPENAI_STREAM') == '1'
+
+
+def request_timeout(read):
+    """httpx timeouts for one API call; `read` bounds the wait for the model's reply."""
+    return httpx.Timeout(connect=10, read=read, write=10, pool=5)
+
+
+# Errors that fail the same way for every row (bad key, unknown model, malformed
+# request). Retrying or moving on to the next row only burns budget, so the
+# classifiers re-raise these and the worker TaskGroup cancels the whole run.
+FATAL_ERRORS = (
+    openai.AuthenticationError,
+    openai.PermissionDeniedError,
+    openai.NotFoundError,
+    openai.BadRequestError,
+)
+
+_client = None
+
+
+def get_client(concurrency, timeout):
+    """Return the shared AsyncOpenAI client, creating it if none is open.
+
+    Use it as `async with get_client(...) as client:` so the connection pool is
+    closed deterministically when the run ends. The next call (e.g. the next
+    stage run from main.py) then builds a fresh client on its own event loop.
+    HTTP/2 multiplexes concurrent requests over a few warm TLS connections.
+    """
+    global _client, CREDITS
+    if _client is None or _client.is_closed():
+        # aiolimiter buckets are bound to one event loop; start fresh with the client
+        CREDITS = CreditLimiter(OPENAI_RPM, OPENAI_TPM)
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=concurrency * 4,
+                max_keepalive_connections=concurrency * 2,
+                keepalive_expiry=60,
+            ),
+            timeout=request_timeout(timeout),
+        )
+        # Retries are done in create_response, so the SDK's own retry layer is off
+        _client = AsyncOpenAI(http_client=http_client, max_retries=0)
+    return _client
+
+
+async def _final_response(stream):
+    """Consume a streamed response and return the finished Response object."""
+    async with stream:
+        async for event in stream:
+            if event.type in ('response.completed', 'response.incomplete', 'response.failed'):
+                return event.response
+            if event.type == 'error':
+                raise RuntimeError(f"stream error: {event.message}")
+    raise RuntimeError("stream ended without a final response")
+
+
+async def create_response(client, timeout, attempts=RETRY_ATTEMPTS, **kwargs):
+    """client.responses.create under the shared request/token budget, with retries.
+
+    Tokens are estimated as len(input) // 4. `timeout` is the httpx read timeout for
+    the call itself (not time spent waiting for credits); httpx enforces it and the
+    SDK raises openai.APITimeoutError. Transient errors are retried up to `attempts`
+    times in total; anything else (or the last failure) is raised.
+    """
+    est_tokens = len(kwargs['input']) // 4
+    for attempt in range(1, attempts + 1):
+        try:
+            async with CREDITS.acquire(est_tokens):
+                raw = await client.responses.with_raw_response.create(
+                    **kwargs, stream=STREAM_RESPONSES, timeout=request_timeout(timeout))
+            CREDITS.update(raw.headers, est_tokens)
+            if STREAM_RESPONSES:
+                return await _final_response(raw.parse())
+            return raw.parse()
+        except Exception as e:
+            if attempt == attempts or not is_transient(e):
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, 2 ** attempt))
+            logger.warning(f"  ⚠️  {type(e).__name__} on attempt {attempt}/{attempts}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def warm_pool(client, n):
+    """Open the pool's connections before the first burst of real requests.
+
+    Fires n cheap `GET /v1/models` calls so the TLS handshakes happen up front
+    instead of stalling the first CONCURRENCY classifications. Failures are
+    ignored: a cold connection is only slower, not wrong.
+    """
+    quick = client.with_options(max_retries=0)
+    await asyncio.gather(*(quick.models.list() for _ in range(n)), return_exceptions=True)
@@ -0,0 +1,174 @@
+"""
+Streaming run of the three GPT stages: company type -> vertical -> sub-vertical.
+
+Running the stage scripts one after another waits for the whole file at every
+step. Here each row moves on to the next stage as soon as its own previous stage
+finishes, so all three worker pools (sized by each script's CONCURRENCY) are busy
+at the same time and wall time approaches the slowest stage instead of the sum.
+
+Reads company_type.INPUT_CSV and writes every result column (Company Type,
+Vertical, Sub Vertical) to company_type.OUTPUT_CSV in one atomic write at the end.
+Values already present in OUTPUT_CSV are kept, and completed API calls are in the
+llm_cache, so an interrupted run resumes cheaply.
+
+The skip rules are the stage scripts' own (e.g. sub-verticals only for rows with a
+Record ID), but Sub Vertical lands in company_type.OUTPUT_CSV, the file the
+sequential run hands to assign_vert; sub_vertical.INPUT_CSV is neither read nor
+written. Point downstream steps at OUTPUT_CSV when running in this mode.
+"""
+
+import os
+import pathlib
+import asyncio
+from dotenv import load_dotenv
+from src import assign_vert, company_type, sub_vertical
+from src.csv_io import iter_rows, write_csv_atomic
+from src.openai_client import FATAL_ERRORS, get_client, warm_pool
+from src.progress_log import get_logger
+from src.prompt_render import compile_template, load_prompt, render
+
+load_dotenv()
+logger = get_logger(__name__)
+
+RESULT_COLS = (
+    company_type.COMPANY_TYPE_COL,
+    assign_vert.VERTICAL_COL,
+    sub_vertical.SUB_VERTICAL_COL,
+)
+URL_COL = 'URL'
+
+
+async def stage_worker(name, queue, process):
+    while True:
+        row = await queue.get()
+        try:
+            await process(row)
+        except FATAL_ERRORS:
+            raise
+        except Exception as e:
+            logger.warning(f"[{name}] {row.get(URL_COL, '')} error: {type(e).__name__}: {e}")
+        finally:
+            queue.task_done()
+
+
+async def run_pipeline():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        logger.error("ERROR: OPENAI_API_KEY not set in environment. Load your .env or set the env var.")
+        return
+
+    type_prompt = compile_template(load_prompt(company_type.PROMPT_PATH), company_type.COL_MAP)
+    vert_prompt = compile_template(load_prompt(assign_vert.PROMPT_PATH), assign_vert.COL_MAP)
+    sub_prompts = sub_vertical.load_compiled_prompts()
+
+    # ---- Results from a previous run, keyed by URL ----
+    existing = {}
+    output_path = pathlib.Path(company_type.OUTPUT_CSV)
+    if output_path.exists():
+        with open(output_path, newline='', encoding='utf-8') as f:
+            _, prior_rows = iter_rows(f)
+            for r in prior_rows:
+                url = r.get(URL_COL, '').strip()
+                if url:
+                    existing[url] = {col: r.get(col, '') for col in RESULT_COLS}
+
+    with open(company_type.INPUT_CSV, newline='', encoding='utf-8') as f:
+        fieldnames, reader = iter_rows(f, extra_cols=RESULT_COLS)
+        rows = list(reader)
+
+    for row in rows:
+        prior = existing.get(row.get(URL_COL, '').strip(), {})
+        for col in RESULT_COLS:
+            if not (row.get(col) or '').strip() and (prior.get(col) or '').strip():
+                row[col] = prior[col]
+
+    types_by_hash = company_type.load_type_cache()
+    concurrency = (company_type.CONCURRENCY, assign_vert.CONCURRENCY, sub_vertical.CONCURRENCY)
+    q_type, q_vert, q_sub = (asyncio.Queue(maxsize=n * 2) for n in concurrency)
+
+    # ---- Routing: each row goes to the first stage it still needs ----
+    async def after_vertical(row):
+        vertical = (row.get(sub_vertical.VERTICAL_COL) or '').strip()
+        if (row.get(sub_vertical.SUB_VERTICAL_COL) or '').strip() or vertical not in sub_vertical.ALLOWED_VERTICALS:
+            return
+        # As in sub_vertical.py, Record ID identifies the row; skip rows without one
+        if not (row.get(sub_vertical.RECORD_ID_COL) or '').strip():
+            logger.info(f"Skipping row with missing {sub_vertical.RECORD_ID_COL}: {row.get(sub_vertical.COMPANY_COL, '')[:60]}")
+            return
+        await q_sub.put(row)
+
+    async def after_type(row):
+        if (row.get(assign_vert.VERTICAL_COL) or '').strip():
+            await after_vertical(row)
+        elif (row.get(company_type.COMPANY_TYPE_COL) or '').strip() in ('Distributor', 'Both'):
+            await q_vert.put(row)
+
+    # ---- Stages ----
+    async with get_client(sum(concurrency), company_type.REQUEST_TIMEOUT) as client:
+
+        async def type_stage(row):
+            values = company_type.prepare_values(row)
+            key = company_type.content_key(values)
+            output = types_by_hash.get(key)
+            if output is None:
+                output = await company_type.classify_company(client, "gpt-5", render(type_prompt, values))
+                if not output.startswith('ERROR'):
+                    types_by_hash[key] = output
+            row[company_type.COMPANY_TYPE_COL] = output
+            await after_type(row)
+
+        async def vertical_stage(row):
+            values = {var: (row.get(col) or '').strip() for var, col in assign_vert.COL_MAP.items()}
+            row[assign_vert.VERTICAL_COL] = await assign_vert.classify_vertical(
+                client, "gpt-5", render(vert_prompt, values), values['company name'])
+            await after_vertical(row)
+
+        async def sub_vertical_stage(row):
+            values = {var: (row.get(col) or '').strip() for var, col in sub_vertical.COL_MAP.items()}
+            compiled = sub_prompts.get(values['VERTICAL']) or sub_prompts['__default__']
+            row[sub_vertical.SUB_VERTICAL_COL] = await sub_vertical.classify_sub_vertical(
+                client, sub_vertical.MODEL, render(compiled, values))
+
+        stages = (
+            ('company_type', q_type, type_stage, concurrency[0]),
+            ('vertical', q_vert, vertical_stage, concurrency[1]),
+            ('sub_vertical', q_sub, sub_vertical_stage, concurrency[2]),
+        )
+        await warm_pool(client, sum(concurrency))
+        async with asyncio.TaskGroup() as tg:
+            workers = [
+                tg.create_task(stage_worker(name, queue, process))
+                for name, queue, process, n in stages
+                for _ in range(n)
+            ]
+            for row in rows:
+                if (row.get(company_type.COMPANY_TYPE_COL) or '').strip():
+                    await after_type(row)
+                elif company_type.has_business_model(row):
+                    await q_type.put(row)
+            # A stage only feeds later stages, so once a queue is drained (and its
+            # workers have routed their rows onward) the next queue is complete.
+            for _, queue, _, _ in stages:
+                await queue.join()
+            for w in workers:
+                w.cancel()
+
+    await asyncio.to_thread(write_csv_atomic, company_type.OUTPUT_CSV, fieldnames, rows)
+    await asyncio.to_thread(company_type.save_type_cache, types_by_hash)
+    logger.info(f"Pipeline complete. Results written to {company_type.OUTPUT_CSV}")
+
+
+def main():
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop and loop.is_running():
+        return run_pipeline()
+    else:
+        return asyncio.run(run_pipeline())
+
+
+if __name__ == '__main__':
+    main()
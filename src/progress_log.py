@@ -0,0 +1,37 @@
+"""
+Non-blocking progress output for the GPT classification scripts.
+
+Log records go onto an in-memory queue and a single background thread
+(QueueListener) writes them to stdout, so a worker coroutine never stalls on the
+console write. Messages are printed bare, as the scripts' old print() calls were.
+Set LOG_LEVEL=WARNING to keep only problems (skips per-row progress lines).
+"""
+
+import os
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+_queue = queue.SimpleQueue()
+_listener = None
+
+
+def get_logger(name):
+    global _listener
+    if _listener is None:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _listener = QueueListener(_queue, handler)
+        _listener.start()
+        # Drain anything still queued before the interpreter exits
+        atexit.register(_listener.stop)
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(QueueHandler(_queue))
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+    return logger
@@ -0,0 +1,33 @@
+import re
+import pathlib
+import functools
+
+# A placeholder is `{name}` on a single line, e.g. `{company name}` or `{BUSINESS_MODEL}`
+_PLACEHOLDER_RE = re.compile(r'(\{[^{}\n]+\})')
+
+
+@functools.lru_cache(maxsize=None)
+def load_prompt(path):
+    """Read a prompt file once per process; repeated main() calls reuse the text."""
+    return pathlib.Path(path).read_text(encoding='utf-8')
+
+
+def compile_template(template, names):
+    """Split a prompt template once into literal chunks and placeholder slots.
+
+    Only `{name}` tokens whose name is in `names` become slots; any other braces
+    (e.g. `{Manufacturer, Distributor, ...}` in company_type.txt) stay literal.
+    Returns (parts, slots) where slots is a list of (index into parts, name).
+    """
+    parts = _PLACEHOLDER_RE.split(template)
+    slots = [(i, parts[i][1:-1]) for i in range(1, len(parts), 2) if parts[i][1:-1] in names]
+    return parts, slots
+
+
+def render(compiled, values):
+    """Fill every slot from `values` (missing names render as '') in one join."""
+    parts, slots = compiled
+    out = parts[:]
+    for i, name in slots:
+        out[i] = values.get(name, '')
+    return ''.join(out)
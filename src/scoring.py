@@ -1,46 +1,40 @@
 import os
-import csv
 import pathlib
 import asyncio
-import traceback
-from collections import defaultdict
+from functools import lru_cache
 from dotenv import load_dotenv, find_dotenv
-from openai import AsyncOpenAI
+from src._classifier import cached_response
+from src.csv_io import append_journal, iter_rows, load_journal, open_journal, write_csv_atomic
+from src.openai_batch import BATCH_MODE, prime_cache
+from src.openai_client import FATAL_ERRORS, OPENAI_TPM, get_client, warm_pool
+from src.progress_log import get_logger
+from src.prompt_render import compile_template, load_prompt, render
+
+logger = get_logger(__name__)
 
 # Load .env
 load_dotenv()
-print("Loaded .env from:", find_dotenv())
+logger.info(f"Loaded .env from: {find_dotenv()}")
 
 INPUT_CSV = 'data/net_new_web_info_company_type_parsed.csv'
 SCORE_COL = 'Score'
 VERTICAL_COL = 'Vertical'
 URL_COL = 'URL'
+PROMPTS_DIR = 'prompts/vertical-specific-scoring'
 
 CONCURRENCY = 10  # adjust concurrency as needed
+MIN_VERTICAL_CONCURRENCY = 2  # floor for verticals with very large prompts
 REQUEST_TIMEOUT = 45
-MAX_RETRIES = 3
-
-input_path = pathlib.Path(INPUT_CSV)
-with open(input_path, newline='', encoding='utf-8') as f:
-    reader = csv.DictReader(f)
-    fieldnames = reader.fieldnames
-    rows = list(reader)
-
-# If Score column missing, add it *without touching existing data*
-if SCORE_COL not in fieldnames:
-    new_fieldnames = fieldnames + [SCORE_COL]
-    for row in rows:
-        row[SCORE_COL] = ""  # leave blank
-
-    # Rewrite CSV but keep ALL original data exactly the same
-    with open(input_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=new_fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+MAX_RETRIES = 5  # attempts for transient API errors (see openai_client.create_response)
+SAVE_EVERY = 50  # checkpoint the CSV every N scored rows...
+CHECKPOINT_SECONDS = 10  # ...or after this long without a new score, if any are unsaved
+# Per-row results keyed by URL, for resuming after a crash between checkpoints
+JOURNAL_PATH = str(pathlib.Path(INPUT_CSV).with_suffix('.scoring.jsonl'))
 
 # ------------------------
 # Helpers
 # ------------------------
+@lru_cache(maxsize=128)  # pure, and rows only carry a handful of distinct verticals
 def normalize_vertical(v: str) -> str:
     """Lowercase, remove spaces, hyphens, and slashes for consistent matching."""
     return v.lower().replace(" ", "").replace("-", "").replace("/", "")
@@ -78,32 +72,115 @@ COLUMN_MAP = {
 }
 
 
+def load_compiled_prompts():
+    """Read and compile every vertical's scoring prompt once (normalized vertical -> template).
+    Verticals whose prompt file is missing are left out."""
+    templates = {}
+    for vertical, fname in VERTICAL_PROMPT_MAP.items():
+        prompt_file = pathlib.Path(PROMPTS_DIR) / fname
+        if prompt_file.exists():
+            templates[vertical] = compile_template(load_prompt(str(prompt_file)), COLUMN_MAP)
+    return templates
+
+
+def vertical_concurrency(templates):
+    """In-flight cap per vertical, scaled to its prompt size.
+
+    Scoring prompts differ ~5x in length, so one shared cap either starves the small
+    ones or lets the big ones blow through the TPM budget. Each vertical gets
+    OPENAI_TPM // (template tokens * 60) slots (budget for one call per slot per
+    second), between MIN_VERTICAL_CONCURRENCY and CONCURRENCY. Tokens use the same
+    len // 4 estimate as create_response.
+    """
+    caps = {}
+    for vertical, (parts, _) in templates.items():
+        tokens = max(sum(len(p) for p in parts) // 4, 1)
+        caps[vertical] = min(CONCURRENCY, max(MIN_VERTICAL_CONCURRENCY, OPENAI_TPM // (tokens * 60)))
+    return caps
+
+
 async def classify_score_once(client, model, prompt: str):
-    coro = client.responses.create(model=model, input=prompt)
-    result = await asyncio.wait_for(coro, timeout=REQUEST_TIMEOUT)
-    return getattr(result, "output_text", str(result)).strip()
+    return await cached_response(client, model, prompt, REQUEST_TIMEOUT, MAX_RETRIES)
 
 
 async def run_all():
     input_path = pathlib.Path(INPUT_CSV)
     with open(input_path, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        header_map = {h.lower(): h for h in reader.fieldnames}
-        fieldnames = list(reader.fieldnames)
-        if SCORE_COL not in fieldnames:
-            fieldnames.append(SCORE_COL)
+        # Score is added here if the file lacks it (the first checkpoint writes it out);
+        # rows come back full width, so a checkpoint never sees a row change shape
+        fieldnames, reader = iter_rows(f, extra_cols=(SCORE_COL,))
+        header_map = {h.lower(): h for h in fieldnames}
         rows = list(reader)
 
+    # Resume support: scores journaled by a previous, interrupted run
+    journaled = {e['url']: e[SCORE_COL] for e in load_journal(JOURNAL_PATH)}
+    for row in rows:
+        url = row.get(URL_COL, '').strip()
+        if not row[SCORE_COL].strip() and url in journaled:
+            row[SCORE_COL] = journaled[url]
+    if journaled:
+        logger.info(f"Resumed {len(journaled)} scores from {JOURNAL_PATH}")
+
     def get_row_value(row, col_name):
         return row.get(header_map.get(col_name.lower(), col_name), "")
 
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY not set in environment.")
-    client = AsyncOpenAI(api_key=api_key)
     model = "gpt-5"
+    prompt_templates = load_compiled_prompts()
+    # Caps in-flight calls (pool size); request/token pacing is in create_response
     SEMAPHORE = asyncio.Semaphore(CONCURRENCY)
-    file_lock = asyncio.Lock()  # Add lock for thread-safe file writing
+    # ...and within that, each vertical's share, so large prompts can't take every slot
+    vertical_semaphores = {v: asyncio.Semaphore(n) for v, n in vertical_concurrency(prompt_templates).items()}
+    journal = open_journal(JOURNAL_PATH)
+    # (url, score) from process_row, then None to stop; drained by writer(), the only
+    # coroutine touching disk
+    results_queue = asyncio.Queue()
+
+    async def checkpoint(scored):
+        try:
+            # Scores are filled into `rows` in place, so it is the current state
+            await asyncio.to_thread(write_csv_atomic, INPUT_CSV, fieldnames, rows)
+            logger.info(f"Progress saved to {INPUT_CSV} ({scored} scored)")
+        except Exception as e:
+            logger.exception(f"Warning: failed to save progress: {e}")
+
+    async def writer():
+        """Journal each score and checkpoint the CSV every SAVE_EVERY scores (or when
+        results go quiet), so workers never wait on disk I/O."""
+        scored = unsaved = 0
+        while True:
+            try:
+                item = await asyncio.wait_for(results_queue.get(), timeout=CHECKPOINT_SECONDS)
+            except asyncio.TimeoutError:
+                if unsaved:
+                    await checkpoint(scored)
+                    unsaved = 0
+                continue
+            if item is None:
+                return
+            url, score = item
+            try:
+                if url:
+                    append_journal(journal, {'url': url, SCORE_COL: score})
+                scored += 1
+                unsaved += 1
+                if unsaved >= SAVE_EVERY:
+                    await checkpoint(scored)
+                    unsaved = 0
+            except Exception as e:
+                logger.warning(f"Warning: failed to journal score for {url}: {e}")
+            finally:
+                results_queue.task_done()
+
+    def build_prompt(row):
+        """The row's scoring prompt, or None if its vertical has no prompt file."""
+        prompt_template = prompt_templates.get(normalize_vertical(get_row_value(row, VERTICAL_COL)))
+        if prompt_template is None:
+            return None
+        prompt_vars = {k: get_row_value(row, v) for k, v in COLUMN_MAP.items()}
+        return render(prompt_template, prompt_vars)
 
     async def process_row(row):
         if row.get(SCORE_COL, "").strip():
@@ -111,126 +188,73 @@ async def run_all():
 
         try:
             vertical_raw = get_row_value(row, VERTICAL_COL)
-            vertical = normalize_vertical(vertical_raw)
 
             # Skip rows where vertical not mapped or prompt file missing, leave score blank
-            if vertical not in VERTICAL_PROMPT_MAP:
-                print(f"{vertical_raw}: PROMPT FILE NOT FOUND")
+            prompt = build_prompt(row)
+            if prompt is None:
+                logger.warning(f"{vertical_raw}: PROMPT FILE NOT FOUND")
                 return row
 
-            prompt_file = pathlib.Path('prompts/vertical-specific-scoring') / VERTICAL_PROMPT_MAP[vertical]
-            if not prompt_file.exists():
-                print(f"{vertical_raw}: PROMPT FILE NOT FOUND")
-                return row
-
-            prompt_template = prompt_file.read_text(encoding='utf-8')
-            prompt_vars = {k: get_row_value(row, v) for k, v in COLUMN_MAP.items()}
-            prompt = prompt_template.format_map(defaultdict(str, prompt_vars))
-
             last_exc = None
             score = None
-            for attempt in range(1, MAX_RETRIES + 1):
-                try:
-                    async with SEMAPHORE:
-                        score = await classify_score_once(client, model, prompt)
-                    break
-                except asyncio.TimeoutError as te:
-                    last_exc = te
-                    print(f"Timeout on attempt {attempt} for {row.get('Company name')} (vertical={vertical_raw})")
-                except Exception as e:
-                    last_exc = e
-                    print(f"Attempt {attempt} failed for {row.get('Company name')} (vertical={vertical_raw}): {type(e).__name__}: {e}")
-
-                if attempt < MAX_RETRIES:
-                    backoff = 2 ** (attempt - 1)
-                    await asyncio.sleep(backoff)
+            try:
+                async with vertical_semaphores[normalize_vertical(vertical_raw)], SEMAPHORE:
+                    score = await classify_score_once(client, model, prompt)
+            except FATAL_ERRORS:
+                raise
+            except Exception as e:
+                last_exc = e
 
             if score is None:
-                err_msg = f"ERROR: Failed after {MAX_RETRIES} attempts: {type(last_exc).__name__}: {str(last_exc)}"
-                print(err_msg)
+                err_msg = f"ERROR: Failed for {row.get('Company name')} (vertical={vertical_raw}): {type(last_exc).__name__}: {str(last_exc)}"
+                logger.error(err_msg)
                 row[SCORE_COL] = err_msg
             else:
                 row[SCORE_COL] = score
-                print(f"{vertical_raw} -> {str(score)[:100]}")
-
-            # Save row immediately - use URL as unique identifier
-            try:
-                url = row.get(URL_COL, '').strip()
-                async with file_lock:  # Protect file writes from concurrent access
-                    with open(INPUT_CSV, 'r', newline='', encoding='utf-8') as f:
-                        existing = list(csv.DictReader(f))
-                    updated = False
-                    for r in existing:
-                        if r.get(URL_COL, '').strip() == url:
-                            r[SCORE_COL] = row[SCORE_COL]
-                            updated = True
-                            break
-                    if not updated:
-                        new_row = {k: "" for k in existing[0].keys()} if existing else {}
-                        for k in row:
-                            new_row[k] = row[k]
-                        existing.append(new_row)
-
-                    write_fieldnames = list(existing[0].keys())
-                    if SCORE_COL not in write_fieldnames:
-                        write_fieldnames.append(SCORE_COL)
-                        for r in existing:
-                            r.setdefault(SCORE_COL, "")
-
-                    with open(INPUT_CSV, 'w', newline='', encoding='utf-8') as f:
-                        writer = csv.DictWriter(f, fieldnames=write_fieldnames)
-                        writer.writeheader()
-                        writer.writerows(existing)
-            except Exception as e:
-                print(f"Warning: failed to save row for {row.get('Company name')}: {e}")
-                traceback.print_exc()
+                logger.info(f"{vertical_raw} -> {str(score)[:100]}")
 
+            # Hand the score to the writer task and go straight back to the network
+            results_queue.put_nowait((row.get(URL_COL, '').strip(), row[SCORE_COL]))
             return row
 
+        except FATAL_ERRORS:
+            raise
         except Exception as e:
-            print(f"Unhandled exception processing {row.get('Company name')}: {type(e).__name__}: {e}")
-            traceback.print_exc()
+            logger.exception(f"Unhandled exception processing {row.get('Company name')}: {type(e).__name__}: {e}")
             row[SCORE_COL] = f"ERROR: Unhandled exception: {type(e).__name__}: {e}"
             return row
 
-    tasks = [asyncio.create_task(process_row(row)) for row in rows]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    normalized_rows = []
-    for idx, res in enumerate(results):
-        if isinstance(res, Exception):
-            print(f"Task {idx} raised exception: {res}")
-            traceback.print_exc()
-            err_row = rows[idx].copy()
-            err_row[SCORE_COL] = f"ERROR: Exception in task: {type(res).__name__}: {res}"
-            normalized_rows.append(err_row)
-        elif res is None:
-            print(f"Task {idx} returned None; converting to error row.")
-            err_row = rows[idx].copy()
-            err_row[SCORE_COL] = "ERROR: Task returned None"
-            normalized_rows.append(err_row)
-        elif not isinstance(res, dict):
-            print(f"Task {idx} returned non-dict ({type(res).__name__}); converting to a row dict.")
-            err_row = rows[idx].copy()
-            err_row[SCORE_COL] = str(res)
-            normalized_rows.append(err_row)
-        else:
-            normalized_rows.append(res)
-
+    # Shared keep-alive/HTTP2 pool; closed when the block exits, even on error
+    async with get_client(CONCURRENCY, REQUEST_TIMEOUT) as client:
+        if BATCH_MODE:
+            prompts = [build_prompt(row) for row in rows if not row[SCORE_COL].strip()]
+            await prime_cache(client, model, [p for p in prompts if p is not None])
+        await warm_pool(client, CONCURRENCY)
+        writer_task = asyncio.create_task(writer())
+        try:
+            # One task per row, so a row waiting on its vertical's share never holds up
+            # another vertical; a fatal error (bad key, no quota, unknown model) cancels
+            # the rest instead of writing an ERROR score into every row
+            async with asyncio.TaskGroup() as tg:
+                for row in rows:
+                    tg.create_task(process_row(row))
+            # Let the writer journal everything still queued, then stop
+            results_queue.put_nowait(None)
+            await writer_task
+        finally:
+            writer_task.cancel()
+            journal.close()
+
+    # process_row scores each row in place, so `rows` is already the final table
     try:
-        final_fieldnames = list(normalized_rows[0].keys()) if normalized_rows else fieldnames
-        if SCORE_COL not in final_fieldnames:
-            final_fieldnames.append(SCORE_COL)
-        with open(input_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=final_fieldnames)
-            writer.writeheader()
-            writer.writerows(normalized_rows)
+        await asyncio.to_thread(write_csv_atomic, input_path, fieldnames, rows)
+        # Everything in the journal is now in INPUT_CSV
+        os.remove(JOURNAL_PATH)
     except Exception as e:
-        print(f"Failed to write final CSV: {e}")
-        traceback.print_exc()
+        logger.exception(f"Failed to write final CSV: {e}")
 
     result_map = {}
-    for i, r in enumerate(normalized_rows):
+    for i, r in enumerate(rows):
         key = r.get('Company name') or f'__row_{i}'
         result_map[key] = r
 
@@ -239,11 +263,11 @@ async def run_all():
 
 def vertical_score_all():
     result = asyncio.run(run_all())
-    print(f"Finished. Processed {len(result)} rows.")
+    logger.info(f"Finished. Processed {len(result)} rows.")
 
     for company, row in result.items():
         score_preview = str(row.get(SCORE_COL, "") or "")[:120]
-        print(f"{company}: {score_preview}")
+        logger.info(f"{company}: {score_preview}")
 
     return result
 
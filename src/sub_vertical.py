@@ -1,16 +1,21 @@
 import os
-import csv
 import pathlib
-import tempfile
 import asyncio
+import openai
 import time
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from src._classifier import cached_response, run_pool
+from src.csv_io import iter_rows, write_csv_atomic
+from src.openai_batch import BATCH_MODE, prime_cache
+from src.openai_client import FATAL_ERRORS, get_client, warm_pool
+from src.progress_log import get_logger
+from src.prompt_render import compile_template, load_prompt, render
 
 # ------------------------
 # Configuration
 # ------------------------
 load_dotenv()
+logger = get_logger(__name__)
 
 INPUT_CSV = os.getenv('INPUT_CSV', 'data/Website_comp_info_company_type.csv')
 PROMPTS_DIR = os.getenv('PROMPTS_DIR', 'prompts/sub-verticals')
@@ -22,110 +27,115 @@ RECORD_ID_COL = os.getenv('RECORD_ID_COL', 'Record ID')  # <-- using Record ID a
 # Concurrency and save frequency (tunable via env)
 CONCURRENCY = int(os.getenv('CONCURRENCY', '15'))
 REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', '45'))
-MAX_RETRIES = int(os.getenv('MAX_RETRIES', '3'))
+MAX_RETRIES = int(os.getenv('MAX_RETRIES', '5'))
 SAVE_EVERY = int(os.getenv('SAVE_EVERY', '50'))  # save progress to disk every N processed rows
 
 # Model selection
 MODEL = os.getenv('OPENAI_MODEL', 'gpt-5')
 
-# ------------------------
-# Helper: classify with retry/backoff
-# ------------------------
-async def classify_sub_vertical(client, model, prompt):
-    last_exc = None
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            coro = client.responses.create(model=model, input=prompt, reasoning={"effort": "high"})
-            result = await asyncio.wait_for(coro, timeout=REQUEST_TIMEOUT)
-            return (getattr(result, "output_text", None) or str(result)).strip()
-        except asyncio.TimeoutError:
-            last_exc = Exception('timeout')
-            err_str = 'ERROR: timeout'
-        except Exception as e:
-            last_exc = e
-            err_str = f"ERROR: {e}"
-
-        # If we're going to retry, sleep with exponential backoff
-        if attempt < MAX_RETRIES:
-            backoff = 2 ** (attempt - 1)
-            await asyncio.sleep(backoff)
-        else:
-            # final attempt failed; return error string
-            return err_str
+# Prompt placeholder -> CSV column
+COL_MAP = {
+    'company name': COMPANY_COL,
+    'VERTICAL': VERTICAL_COL,
+    'BUSINESS_MODEL': 'BUSINESS_MODEL',
+    'PRODUCTS': 'PRODUCTS',
+    'WEBSITE_FINDINGS': 'WEBSITE_FINDINGS',
+    'TARGET_CUSTOMERS': 'TARGET_CUSTOMERS',
+    'DISTRIBUTION FINDINGS': 'DISTRIBUTION FINDINGS',
+    'PRODUCT BRANDS': 'PRODUCT BRANDS',
+    'ADDITIONAL FINDINGS': 'ADDITIONAL FINDINGS',
+}
+
+# Map of vertical -> filename (same as original mapping)
+VERTICAL_PROMPT_MAP = {
+    "Alcohol": "Alcohol.txt",
+    "Bakery": "bakery.txt",
+    "Beverage": "beverage.txt",
+    "Broadline": "Broadline.txt",
+    "C-Store": "c-store.txt",
+    "Ice Cream": "Ice-cream.txt",
+    "Jan-San": "Jan-san.txt",
+    "Meat": "meat.txt",
+    "Produce": "produce.txt",
+    "Seafood": "seafood.txt"
+}
+
+# Allowed verticals (only process rows whose Vertical is in this set)
+ALLOWED_VERTICALS = set(VERTICAL_PROMPT_MAP)
 
 # ------------------------
-# Main async flow
+# Helper: prompt templates
 # ------------------------
-async def main_async():
-    api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        print("ERROR: OPENAI_API_KEY not set in environment. Load your .env or set the env var.")
-        return
-
-    client = AsyncOpenAI()
-    model = MODEL
-
-    # Pre-load all prompt templates into memory (fix for issue #2)
+def load_compiled_prompts():
+    """Pre-load all prompt templates into memory, compiled once (vertical -> template)."""
     prompt_cache = {}
 
     # Load default template
     default_template_path = pathlib.Path(PROMPTS_DIR) / 'Sub-Vertical-Template.txt'
     if default_template_path.exists():
-        prompt_cache['__default__'] = default_template_path.read_text(encoding='utf-8')
+        prompt_cache['__default__'] = load_prompt(str(default_template_path))
     else:
         prompt_cache['__default__'] = ''
 
-    # Map of vertical -> filename (same as original mapping)
-    vertical_prompt_map = {
-        "Alcohol": "Alcohol.txt",
-        "Bakery": "bakery.txt",
-        "Beverage": "beverage.txt",
-        "Broadline": "Broadline.txt",
-        "C-Store": "c-store.txt",
-        "Ice Cream": "Ice-cream.txt",
-        "Jan-San": "Jan-san.txt",
-        "Meat": "meat.txt",
-        "Produce": "produce.txt",
-        "Seafood": "seafood.txt"
-    }
-
     # Preload vertical-specific prompts if available
-    for v, fname in vertical_prompt_map.items():
+    for v, fname in VERTICAL_PROMPT_MAP.items():
         p = pathlib.Path(PROMPTS_DIR) / fname
         if p.exists():
-            prompt_cache[v] = p.read_text(encoding='utf-8')
+            prompt_cache[v] = load_prompt(str(p))
         else:
             prompt_cache[v] = prompt_cache['__default__']
 
+    # Split each template into literal chunks + slots once, not per row
+    return {v: compile_template(t, COL_MAP) for v, t in prompt_cache.items()}
+
+# ------------------------
+# Helper: classify with retry/backoff
+# ------------------------
+async def classify_sub_vertical(client, model, prompt):
+    # Transient errors are retried with jittered backoff inside create_response
+    try:
+        return await cached_response(
+            client, model, prompt, REQUEST_TIMEOUT, MAX_RETRIES, reasoning={"effort": "high"})
+    except FATAL_ERRORS:
+        raise
+    except openai.APITimeoutError:
+        return 'ERROR: timeout'
+    except Exception as e:
+        return f"ERROR: {e}"
+
+# ------------------------
+# Main async flow
+# ------------------------
+async def main_async():
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        logger.error("ERROR: OPENAI_API_KEY not set in environment. Load your .env or set the env var.")
+        return
+
+    model = MODEL
+
+    compiled_prompts = load_compiled_prompts()
+
     # Read CSV once
     input_path = pathlib.Path(INPUT_CSV)
     if not input_path.exists():
-        print(f"ERROR: Input CSV not found at {INPUT_CSV}")
+        logger.error(f"ERROR: Input CSV not found at {INPUT_CSV}")
         return
 
     with open(input_path, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        fieldnames = list(reader.fieldnames or [])
         # Ensure essential columns exist in fieldnames
-        for required in (SUB_VERTICAL_COL, RECORD_ID_COL):
-            if required not in fieldnames:
-                fieldnames.append(required)
+        fieldnames, reader = iter_rows(f, extra_cols=(SUB_VERTICAL_COL, RECORD_ID_COL))
         rows = list(reader)
 
-    # Allowed verticals (only process rows whose Vertical is in this set)
-    ALLOWED_VERTICALS = {
-        "Alcohol", "Bakery", "Beverage", "Broadline", "C-Store",
-        "Ice Cream", "Jan-San", "Meat", "Produce", "Seafood"
-    }
-
-    # Prepare rows to process
+    # Prepare rows to process, normalizing their prompt values once
     rows_to_process = []
+    prepared = []  # (record_id, prompt values), parallel to rows_to_process
     for row in rows:
         # Use Record ID as the unique identifier (fix for issue #5)
         record_id = (row.get(RECORD_ID_COL) or '').strip()
         if not record_id:
             # If there's no Record ID, skip and warn (safer than matching on company name)
-            print(f"Skipping row with missing {RECORD_ID_COL}: {row.get(COMPANY_COL, '')[:60]}")
+            logger.info(f"Skipping row with missing {RECORD_ID_COL}: {row.get(COMPANY_COL, '')[:60]}")
             continue
 
         sub_vertical_raw = row.get(SUB_VERTICAL_COL)
@@ -141,120 +151,78 @@ async def main_async():
             continue
 
         rows_to_process.append(row)
+        prepared.append((record_id, {var: (row.get(col) or '').strip() for var, col in COL_MAP.items()}))
 
     total = len(rows_to_process)
-    print(f"{total} rows will be processed (not skipped).")
-
-    SEMAPHORE = asyncio.Semaphore(CONCURRENCY)
+    logger.info(f"{total} rows will be processed (not skipped).")
 
     processed_count = 0
-    processed_map = {}  # record_id -> processed row
+    save_lock = asyncio.Lock()  # one checkpoint write at a time
 
     async def process_row(row, idx):
         nonlocal processed_count
-        # Pull all relevant columns
-        business_model = (row.get('BUSINESS_MODEL') or '').strip()
-        products = (row.get('PRODUCTS') or '').strip()
-        website_findings = (row.get('WEBSITE_FINDINGS') or '').strip()
-        target_customers = (row.get('TARGET_CUSTOMERS') or '').strip()
-        distribution_findings = (row.get('DISTRIBUTION FINDINGS') or '').strip()
-        product_brands = (row.get('PRODUCT BRANDS') or '').strip()
-        additional_info = (row.get('ADDITIONAL FINDINGS') or '').strip()
-        vertical = (row.get(VERTICAL_COL) or '').strip()
-        company_name = (row.get(COMPANY_COL) or '').strip()
-        record_id = (row.get(RECORD_ID_COL) or '').strip()
+        record_id, values = prepared[idx]
+        vertical = values['VERTICAL']
+        company_name = values['company name']
 
-        # Select prompt template from cache
-        prompt_template = prompt_cache.get(vertical) or prompt_cache['__default__']
-
-        # Build prompt safely using replacements
-        prompt = prompt_template
-        # Use a simple replace for placeholders that are known to appear in templates
-        replacements = {
-            '{company name}': company_name,
-            '{VERTICAL}': vertical,
-            '{BUSINESS_MODEL}': business_model,
-            '{PRODUCTS}': products,
-            '{WEBSITE_FINDINGS}': website_findings,
-            '{TARGET_CUSTOMERS}': target_customers,
-            '{DISTRIBUTION FINDINGS}': distribution_findings,
-            '{PRODUCT BRANDS}': product_brands,
-            '{ADDITIONAL FINDINGS}': additional_info,
-        }
-        for k, v in replacements.items():
-            prompt = prompt.replace(k, v)
+        # Select the compiled prompt template and render it in a single pass
+        compiled = compiled_prompts.get(vertical) or compiled_prompts['__default__']
+        prompt = render(compiled, values)
 
         output = await classify_sub_vertical(client, model, prompt)
+        # Rows are updated in place, so `rows` is always the full current state
         row[SUB_VERTICAL_COL] = output
-
-        # Update processed_map by Record ID (fix for issue #5)
-        processed_map[record_id] = row
         processed_count += 1
 
-        print(f"[{idx+1}/{total}] {company_name} (ID={record_id}): {output[:120]}")
+        logger.info(f"[{idx+1}/{total}] {company_name} (ID={record_id}): {output[:120]}")
 
         # Periodic save to disk instead of every row (fix for issue #1)
         if processed_count % SAVE_EVERY == 0 or processed_count == total:
-            await save_progress(rows, processed_map, fieldnames, input_path)
+            # Blocking write runs in a thread so in-flight API calls keep going
+            async with save_lock:
+                await asyncio.to_thread(save_progress, rows, fieldnames, input_path)
 
         return row
 
-    async def sem_task(row, idx):
-        async with SEMAPHORE:
-            return await process_row(row, idx)
-
-    # Launch tasks
-    tasks = [asyncio.create_task(sem_task(row, i)) for i, row in enumerate(rows_to_process)]
-    gathered = await asyncio.gather(*tasks, return_exceptions=True)
-
-    # Merge results back into original row list using Record ID
-    final_rows = []
-    for row in rows:
-        record_id = (row.get(RECORD_ID_COL) or '').strip()
-        if record_id and record_id in processed_map:
-            final_rows.append(processed_map[record_id])
-        else:
-            final_rows.append(row)
+    def report_error(item, e):
+        logger.warning(f"Row {item[1]} error: {type(e).__name__}: {e}")
+
+    # Bounded producer/consumer: CONCURRENCY workers, O(CONCURRENCY) rows queued.
+    # A fatal error cancels the run; leaving the client block closes the pool either way.
+    async with get_client(CONCURRENCY, REQUEST_TIMEOUT) as client:
+        if BATCH_MODE:
+            prompts = [
+                render(compiled_prompts.get(values['VERTICAL']) or compiled_prompts['__default__'], values)
+                for _, values in prepared
+            ]
+            await prime_cache(client, model, prompts, reasoning={"effort": "high"})
+        await warm_pool(client, CONCURRENCY)
+        await run_pool(
+            ((row, i) for i, row in enumerate(rows_to_process)),
+            lambda item: process_row(*item),
+            CONCURRENCY,
+            report_error,
+        )
 
     # Final save (single write) (addresses issue #1)
-    await save_final(rows=final_rows, fieldnames=fieldnames, input_path=input_path)
+    await asyncio.to_thread(save_final, rows, fieldnames, input_path)
 
-    print("Completed processing with concurrency.")
+    logger.info("Completed processing with concurrency.")
 
 # ------------------------
 # Helpers: save functions
 # ------------------------
-async def save_progress(rows, processed_map, fieldnames, input_path):
-    """Saves current progress by merging processed_map into rows and writing to disk.
+def save_progress(rows, fieldnames, input_path):
+    """Saves current progress (rows are updated in place) with an fsync'd atomic write.
     This is called periodically (every SAVE_EVERY rows) rather than after every single row.
+    Blocking; main_async runs it via asyncio.to_thread.
     """
-    merged = []
-    for r in rows:
-        rid = (r.get(RECORD_ID_COL) or '').strip()
-        if rid and rid in processed_map:
-            merged.append(processed_map[rid])
-        else:
-            merged.append(r)
-
-    # atomic write
-    tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_', suffix='.csv', dir=str(input_path.parent))
-    os.close(tmp_fd)
-    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(merged)
-    os.replace(tmp_path, str(input_path))
-    print(f"Progress saved to {input_path} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-
-async def save_final(rows, fieldnames, input_path):
-    tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_final_', suffix='.csv', dir=str(input_path.parent))
-    os.close(tmp_fd)
-    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
-    os.replace(tmp_path, str(input_path))
-    print(f"Final results saved to {input_path}")
+    write_csv_atomic(input_path, fieldnames, rows)
+    logger.info(f"Progress saved to {input_path} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+def save_final(rows, fieldnames, input_path):
+    write_csv_atomic(input_path, fieldnames, rows, prefix='tmp_final_')
+    logger.info(f"Final results saved to {input_path}")
 
 # ------------------------
 # Entrypoint
@@ -266,8 +234,8 @@ def main():
         loop = None
 
     if loop and loop.is_running():
-        print("Detected running event loop — scheduling processing as a background task.")
-        return asyncio.create_task(main_async())
+        # Hand the coroutine back so the async caller awaits it (see main.pipeline)
+        return main_async()
     else:
         return asyncio.run(main_async())
 
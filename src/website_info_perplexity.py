@@ -5,13 +5,18 @@ and writes all original columns plus a new column with the API result to Website
 Skips rows where Website Information is already populated.
 """
 
-import csv
+import os
 import pathlib
+import random
 import asyncio
+import aiohttp
+import httpx
+import perplexity
+from aiolimiter import AsyncLimiter
+from httpx_aiohttp import AiohttpTransport
 from perplexity import AsyncPerplexity, DefaultAioHttpClient
 from dotenv import load_dotenv
-
-csv.field_size_limit(10**7)  # adjust if needed
+from src.csv_io import append_journal, iter_rows, load_journal, open_journal, write_csv_atomic
 
 load_dotenv()
 
@@ -20,24 +25,176 @@ OUTPUT_CSV = 'data/net_new_web_info.csv'
 PROMPT_PATH = 'prompts/Website_info.txt'
 URL_COL = 'URL'
 RESULT_COL = 'Website Information'
+# Append-only checkpoint of completed rows; merged into OUTPUT_CSV once at the end
+JOURNAL_PATH = str(pathlib.Path(OUTPUT_CSV).with_suffix('.partial.jsonl'))
+CONCURRENCY = 6  # starting cap on in-flight Perplexity requests
+# Requests-per-minute budget for the Perplexity account (token bucket)
+PERPLEXITY_RPM = int(os.getenv('PERPLEXITY_RPM', '50'))
+
+# Transient failures (429, 5xx, dropped connections, timeouts) are retried with
+# full-jitter exponential backoff, or after the server's Retry-After when it sends one,
+# instead of leaving an ERROR in the row.
+RETRY_ATTEMPTS = int(os.getenv('PERPLEXITY_RETRY_ATTEMPTS', '5'))
+RETRY_MAX_DELAY = 60
+
+THINK_START = '<think>'
+THINK_END = '</think>'
+# Answers longer than this are a model stuck in a loop (e.g. on a bad URL), and
+# bad_reason_cleaner replaces them with N/A anyway (its THRESHOLD). Streaming lets
+# us stop reading, and paying for, such an answer as soon as it crosses the limit.
+MAX_ANSWER_CHARS = 7500
+# The same loop can also happen inside the reasoning: <think> is opened and never
+# closed, so no answer ever starts. At roughly 4 characters a token, a block still
+# open past this has used most of the 5000 max_tokens, leaving no room for an answer.
+MAX_THINK_CHARS = 12000
+
+
+def is_transient(exc):
+    # APIConnectionError includes APITimeoutError
+    if isinstance(exc, (perplexity.RateLimitError, perplexity.APIConnectionError)):
+        return True
+    return isinstance(exc, perplexity.APIStatusError) and exc.status_code >= 500
+
+
+def retry_after(exc):
+    """Seconds from a Retry-After header on the error's response, if any."""
+    response = getattr(exc, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class AdmissionController:
+    """Caps in-flight requests like a semaphore, but the cap can be changed at runtime.
+
+    asyncio.Semaphore has no supported way to resize; this keeps an explicit
+    in-flight count under a Condition, so set_cap() can shrink the limit (e.g. on
+    rate limiting) or grow it again and waiters are re-checked against the new cap.
+    """
+
+    def __init__(self, cap):
+        self._cap = cap
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def cap(self):
+        return self._cap
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < self._cap)
+            self._in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify(1)
+
+    async def set_cap(self, n):
+        async with self._cond:
+            self._cap = max(1, n)
+            self._cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+def make_http_client():
+    """aiohttp-backed HTTP client for AsyncPerplexity with an explicitly sized pool.
+
+    One session serves the whole run, so TLS connections are kept alive between
+    requests (keepalive_timeout) and the API host's DNS lookup is cached (ttl_dns_cache).
+    """
+    def session():
+        # Built lazily by the transport, on the running event loop
+        # Every request goes to the one API host, so limit_per_host is the real cap. It
+        # must stay at or above CONCURRENCY (the admission ceiling) so no admitted request
+        # waits for a connection; the spare two cover a connection still being closed.
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=8,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            ssl=httpx.create_ssl_context(),
+        )
+        return aiohttp.ClientSession(connector=connector)
+    return DefaultAioHttpClient(transport=AiohttpTransport(client=session))
 
 def load_prompt(path):
     with open(path, 'r', encoding='utf-8') as f:
         return f.read()
 
-async def async_call_perplexity_client(client, prompt_text):
+async def read_stream(stream):
+    """Join a streamed completion's text, or return 'N/A' and close the stream early
+    once the answer exceeds MAX_ANSWER_CHARS, or a <think> block is still open after
+    MAX_THINK_CHARS. The answer is everything after </think> when the stream opens
+    with <think>, otherwise the whole text."""
+    parts = []
+    total = 0
+    answer_start = None  # offset where the answer begins in the joined text
+    opens_with_think = None  # undecided until the leading text rules it in or out
+    tail = ''  # end of the text so far, to find a marker split across chunks
     try:
-        completion = await client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt_text}],
-            model="sonar-pro",
-            reasoning_effort="high",
-            max_tokens=5000
-        )
-        if hasattr(completion, 'choices') and completion.choices:
-            return completion.choices[0].message.content
-        return str(completion)
-    except Exception as e:
-        return f"ERROR: {e}"
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content or ''
+            parts.append(piece)
+            if opens_with_think is None:
+                head = ''.join(parts).lstrip()
+                if len(head) >= len(THINK_START) or not THINK_START.startswith(head):
+                    opens_with_think = head.startswith(THINK_START)
+                    if not opens_with_think:
+                        answer_start = 0
+            if opens_with_think and answer_start is None:
+                window = tail + piece
+                i = window.find(THINK_END)
+                if i != -1:
+                    answer_start = total - len(tail) + i + len(THINK_END)
+                tail = window[-(len(THINK_END) - 1):]
+            total += len(piece)
+            if answer_start is None:
+                if opens_with_think and total > MAX_THINK_CHARS:
+                    return 'N/A'
+            elif total - answer_start > MAX_ANSWER_CHARS:
+                return 'N/A'
+    finally:
+        await stream.close()
+    return ''.join(parts)
+
+async def async_call_perplexity_client(client, prompt_text, limiter=None, admission=None):
+    """One Perplexity completion, retried on transient errors; 'ERROR: ...' if it fails.
+
+    `limiter` (AsyncLimiter) paces every attempt. On a 429, `admission`'s cap is
+    halved; each success raises it by one again, back up to CONCURRENCY.
+    """
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            if limiter is not None:
+                await limiter.acquire()
+            completion = await client.chat.completions.create(
+                messages=[{"role": "user", "content": prompt_text}],
+                model="sonar-pro",
+                reasoning_effort="high",
+                max_tokens=5000,
+                stream=True
+            )
+            text = await read_stream(completion)
+            if admission is not None and admission.cap < CONCURRENCY:
+                await admission.set_cap(admission.cap + 1)
+            return text
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS or not is_transient(e):
+                return f"ERROR: {e}"
+            if admission is not None and isinstance(e, perplexity.RateLimitError):
+                await admission.set_cap(admission.cap // 2)
+            delay = retry_after(e) or random.uniform(0, min(RETRY_MAX_DELAY, 2 ** attempt))
+            print(f'  {type(e).__name__} on attempt {attempt}/{RETRY_ATTEMPTS}, retrying in {delay:.1f}s')
+            await asyncio.sleep(delay)
 
 def main():
     async def async_main():
@@ -45,51 +202,56 @@ def main():
         input_path = pathlib.Path(INPUT_CSV)
         output_path = pathlib.Path(OUTPUT_CSV)
 
-        # Load input CSV
-        with open(input_path, newline='', encoding='utf-8') as inf:
-            reader = csv.DictReader(inf)
-            rows = list(reader)
-            input_fieldnames = reader.fieldnames or []
-
-        # Load existing output CSV to preserve all columns
-        existing_rows = {}
-        all_fieldnames = list(input_fieldnames)
+        # Results already in the output CSV from a previous run, keyed by URL
+        existing_results = {}
         if output_path.exists():
             with open(output_path, newline='', encoding='utf-8') as outf:
-                out_reader = csv.DictReader(outf)
+                _, out_reader = iter_rows(outf)
                 for r in out_reader:
-                    key = r.get(URL_COL, '').strip()
-                    existing_rows[key] = r
-                    # Add any extra columns not in input CSV
-                    for col in r.keys():
-                        if col not in all_fieldnames:
-                            all_fieldnames.append(col)
-        # Ensure RESULT_COL is in fieldnames
-        if RESULT_COL not in all_fieldnames:
-            all_fieldnames.append(RESULT_COL)
-
-        # Merge existing info
+                    result = r.get(RESULT_COL, '')
+                    if result:
+                        existing_results[r.get(URL_COL, '').strip()] = result
+
+        # Load input CSV; rows are cell lists sharing one column index, with room for RESULT_COL
+        with open(input_path, newline='', encoding='utf-8') as inf:
+            all_fieldnames, reader = iter_rows(inf, extra_cols=(RESULT_COL,))
+            rows = list(reader)
+
+        # Merge existing info: only the result column is carried over
         for row in rows:
             url = row.get(URL_COL, '').strip()
-            if url in existing_rows:
-                row.update(existing_rows[url])
+            if not row[RESULT_COL].strip() and url in existing_results:
+                row[RESULT_COL] = existing_results[url]
 
-        semaphore = asyncio.Semaphore(6)  # limit concurrency
+        # Resume support: results journaled by a previous, interrupted run (keyed by URL)
+        journaled = {e['url']: e[RESULT_COL] for e in load_journal(JOURNAL_PATH)}
+        for row in rows:
+            url = row.get(URL_COL, '').strip()
+            if not row.get(RESULT_COL, '').strip() and url in journaled:
+                row[RESULT_COL] = journaled[url]
+        if journaled:
+            print(f'Resumed {len(journaled)} results from {JOURNAL_PATH}')
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        # Each result is one flushed line; no lock, rename or fsync needed per row
+        journal = open_journal(JOURNAL_PATH)
+
+        admission = AdmissionController(CONCURRENCY)  # limit concurrency
+        limiter = AsyncLimiter(PERPLEXITY_RPM, 60)
 
         async def limited_request(client, idx, prompt, url):
-            async with semaphore:
+            async with admission:
                 print(f'Querying Perplexity for: {url}')
-                result = await async_call_perplexity_client(client, prompt)
-                if result and "</think>" in result:
-                    result = result.split("</think>", 1)[1].strip()
+                result = await async_call_perplexity_client(client, prompt, limiter, admission)
+                # Keep only the answer after the model's reasoning block
+                _, think_end, answer = result.partition(THINK_END)
+                if think_end:
+                    result = answer.strip()
                 rows[idx][RESULT_COL] = result
 
-                # Save progress safely after each row
-                output_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(output_path, 'w', newline='', encoding='utf-8') as outf:
-                    writer = csv.DictWriter(outf, fieldnames=all_fieldnames)
-                    writer.writeheader()
-                    writer.writerows(rows)
+                # Journal the result instead of rewriting the whole CSV after every row;
+                # serializing and flushing a multi-KB answer runs off the event loop
+                await asyncio.to_thread(append_journal, journal, {'url': url, RESULT_COL: result})
                 print(f'Progress saved after row {idx+1}/{len(rows)}')
 
         blocklist = [
@@ -110,7 +272,8 @@ def main():
             "http://linkedin.com"
 
         ]
-        async with AsyncPerplexity(http_client=DefaultAioHttpClient()) as client:
+        # Retries happen in async_call_perplexity_client, not also inside the SDK
+        async with AsyncPerplexity(http_client=make_http_client(), max_retries=0) as client:
             tasks = []
             for idx, row in enumerate(rows):
                 url = row.get(URL_COL, '').strip()
@@ -133,7 +296,15 @@ def main():
                 else:
                     prompt = f'{prompt_template}\n\nWebsite: {url}'
                 tasks.append(limited_request(client, idx, prompt, url))
-            await asyncio.gather(*tasks)
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                journal.close()
+
+        # limited_request fills in the rows in place, so `rows` holds every result
+        await asyncio.to_thread(write_csv_atomic, OUTPUT_CSV, all_fieldnames, rows)
+        # Everything in the journal is now in OUTPUT_CSV
+        os.remove(JOURNAL_PATH)
 
         print(f'Finished writing results to {OUTPUT_CSV}')
 
@@ -1,5 +1,5 @@
 import csv
-csv.field_size_limit(10**7)
+from src.csv_io import atomic_csv_writer, iter_rows
 
 INPUT_CSV = 'data/net_new_web_info.csv'
 COLUMN = 'Website Information'
@@ -9,10 +9,14 @@ def count_long_fields():
     count = 0
     total = 0
     over_urls = []
-    rows = []
     with open(INPUT_CSV, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames or []
+        fieldnames = next(csv.reader(f), [])
+    # Stream each fixed row to a temp file that replaces INPUT_CSV at the end, so
+    # only one row is in memory at a time (input is closed before the replace)
+    with atomic_csv_writer(INPUT_CSV, fieldnames, prefix='tmp_clean_') as writer, \
+            open(INPUT_CSV, newline='', encoding='utf-8') as f:
+        # Row objects are written back positionally, without a dict per row
+        _, reader = iter_rows(f)
         for row in reader:
             val = row.get(COLUMN, '')
             # Fix typo in Website Information
@@ -25,18 +29,13 @@ def count_long_fields():
                 count += 1
                 over_urls.append(row.get('Website URL', ''))
                 row[COLUMN] = 'N/A'
-            rows.append(row)
+            writer.writerow(row)
             total += 1
     print(f"Rows with '{COLUMN}' > {THRESHOLD} chars: {count} / {total}")
     if over_urls:
         print('URLs with long Website Information:')
         for url in over_urls:
             print(url)
-    # Write back the modified rows
-    with open(INPUT_CSV, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
 
 if __name__ == '__main__':
     count_long_fields()
@@ -2,23 +2,41 @@
 Script to clean the 'Website URL' column in a CSV by adding 'https://' if missing or if url is not homepage.
 Reads from 'data/Unknown Vert.csv' and writes to 'data/cleaned_url_unknown_vert.csv'.
 """
+import re
 import csv
 import pathlib
 from urllib.parse import urlparse
+from src.csv_io import WRITE_BUFFER
 
 INPUT_CSV = 'data/known Vert.csv'
 OUTPUT_CSV = 'data/cleaned_url_known_vert.csv'
 URL_COL = 'Website URL'
 KEEP_COLS = ['Record ID', 'Company name', 'Website URL']
+# Webmail/search domains that aren't company sites; one case-insensitive pass per URL
+BLOCK_RE = re.compile(r'google|outlook|yahoo', re.IGNORECASE)
+
+# Host part of a URL after "scheme://": everything up to the first /, ? or #
+NETLOC_RE = re.compile(r'[^/?#]*')
+# Characters urlparse rewrites or validates; URLs containing them take the slow path
+URLPARSE_SPECIAL_RE = re.compile(r'[\t\r\n\[\]]')
 
 def clean_url(url):
     url = (url or '').strip()
     if not url:
         return url
     # Add https:// if missing
-    if not url.startswith(('http://', 'https://')):
+    if url.startswith('http://'):
+        scheme, rest = 'http', url[7:]
+    elif url.startswith('https://'):
+        scheme, rest = 'https', url[8:]
+    else:
+        scheme, rest = 'https', url
         url = f'https://{url}'
-    # Parse and reconstruct only scheme + netloc
+    # Keep only scheme + netloc. Plain ASCII hosts are sliced directly; anything
+    # else goes through urlparse as before (same result, but builds a ParseResult)
+    netloc = NETLOC_RE.match(rest).group()
+    if netloc and netloc.isascii() and not URLPARSE_SPECIAL_RE.search(url):
+        return f'{scheme}://{netloc}'
     parsed = urlparse(url)
     if parsed.scheme and parsed.netloc:
         return f'{parsed.scheme}://{parsed.netloc}'
@@ -26,7 +44,6 @@ def clean_url(url):
 
 
 def main():
-    blocklist = ["google", "outlook", "yahoo"]
     with open(INPUT_CSV, newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         fieldnames = reader.fieldnames or []
@@ -38,15 +55,15 @@ def main():
         for row in reader:
             cleaned_row = {col: row.get(col, '') for col in KEEP_COLS}
             cleaned_url = clean_url(cleaned_row.get(URL_COL, ''))
-            # Blocklist check
-            if any(bad in cleaned_url.lower() for bad in blocklist):
+            # Blocklist check (cleaned_url is already just scheme://netloc)
+            if BLOCK_RE.search(cleaned_url):
                 continue
             cleaned_row[URL_COL] = cleaned_url
             rows.append(cleaned_row)
 
     outp = pathlib.Path(OUTPUT_CSV)
     outp.parent.mkdir(parents=True, exist_ok=True)
-    with open(outp, 'w', newline='', encoding='utf-8') as f:
+    with open(outp, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER) as f:
         writer = csv.DictWriter(f, fieldnames=KEEP_COLS)
         writer.writeheader()
         writer.writerows(rows)
@@ -1,7 +1,5 @@
-import csv
 import pathlib
-import tempfile
-import os
+from src.csv_io import iter_rows, write_csv_atomic
 
 def main():
 	INPUT_CSV = 'data/Website_comp_info_company_type_v2.csv'
@@ -12,8 +10,7 @@ def main():
 		return
 
 	with open(input_path, newline='', encoding='utf-8') as f:
-		reader = csv.DictReader(f)
-		fieldnames = list(reader.fieldnames or [])
+		fieldnames, reader = iter_rows(f)
 		rows = list(reader)
 
 	changed = False
@@ -24,13 +21,8 @@ def main():
 			changed = True
 
 	if changed:
-		tmp_fd, tmp_path = tempfile.mkstemp(prefix='tmp_clean_', suffix='.csv', dir=str(input_path.parent))
-		os.close(tmp_fd)
-		with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
-			writer = csv.DictWriter(f, fieldnames=fieldnames)
-			writer.writeheader()
-			writer.writerows(rows)
-		os.replace(tmp_path, str(input_path))
+		# Rows are cell lists, written back positionally via a temp file + os.replace
+		write_csv_atomic(input_path, fieldnames, rows, prefix='tmp_clean_')
 		print(f"Blanked out 'ERROR:' values in {input_path}")
 	else:
 		print("No 'ERROR:' values found to blank out.")
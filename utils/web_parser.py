@@ -1,13 +1,23 @@
+import os
+import sys
 import csv
 import pathlib
 import re
+import contextlib
+from itertools import islice
+from multiprocessing import Pool
+from src.csv_io import atomic_csv_writer
 
 INPUT_CSV = 'data/net_new_web_info.csv'
 OUTPUT_CSV = 'data/net_new_web_info_parsed.csv'
-INFO_COL = 'Website Information'
+INFO_COL = sys.intern('Website Information')
+PARSE_WORKERS = os.cpu_count() or 1
+BATCH_ROWS = 8192  # rows read ahead per round, so memory stays bounded while workers parse
+CHUNKSIZE = 256  # rows per task sent to a worker process
 
-# List of categories to extract
-CATEGORIES = [
+# List of categories to extract. Interned: they key every parsed dict, and lookups
+# with the very same string object skip the character comparison.
+CATEGORIES = [sys.intern(cat) for cat in [
     'COMPANY_NAME',
     'PRODUCTS',
     'BUSINESS_MODEL',
@@ -22,31 +32,31 @@ CATEGORIES = [
     'PHONE NUMBERS & EMAILS',
     'ADDRESS',
     'ADDITIONAL FINDINGS'
-]
+]]
 
-# Build regex for each category
-# Use ^[A-Z _]+: to match next label at start of line (multiline)
-CATEGORY_REGEX = {
-    cat: re.compile(rf'{cat}:\s*(.*?)(?=^([A-Z _]+):|$)', re.DOTALL | re.MULTILINE)
-    for cat in CATEGORIES
-}
+# One alternation of every label, so a single scan of the text finds them all
+LABEL_RE = re.compile('(' + '|'.join(map(re.escape, CATEGORIES)) + '):')
+# A label's value, matched from the label's end: the rest of its line after any
+# whitespace, or nothing if that lands on another label at the start of a line.
+# Possessive quantifiers never backtrack, so matching stays linear in the line
+# length even on huge or malformed fields.
+VALUE_RE = re.compile(r'\s*+(?:^[A-Z _]++:|(.*+))', re.MULTILINE)
 
 def parse_info(info):
     if not info or info.strip() == 'N/A':
-        return {cat: 'N/A' for cat in CATEGORIES}
-    result = {}
-    for cat, regex in CATEGORY_REGEX.items():
-        match = regex.search(info)
-        if match:
-            val = match.group(1).strip()
-            result[cat] = val
-        else:
-            result[cat] = 'N/A'
-    return result
+        return dict.fromkeys(CATEGORIES, 'N/A')
+    found = {}
+    for match in LABEL_RE.finditer(info):
+        cat = match.group(1)
+        # First occurrence wins, as with a per-category search
+        if cat not in found:
+            found[cat] = (VALUE_RE.match(info, match.end()).group(1) or '').strip()
+    return {cat: found.get(cat, 'N/A') for cat in CATEGORIES}
 
 def main():
     input_path = pathlib.Path(INPUT_CSV)
     output_path = pathlib.Path(OUTPUT_CSV)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
     with open(input_path, newline='', encoding='utf-8') as inf:
         reader = csv.DictReader(inf)
         fieldnames = reader.fieldnames or []
@@ -54,20 +64,19 @@ def main():
         exclude = {'Vertical', INFO_COL}
         base_fieldnames = [f for f in fieldnames if f not in exclude]
         new_fieldnames = base_fieldnames + CATEGORIES
-        rows = []
-        for row in reader:
-            info = row.get(INFO_COL, '')
-            parsed = parse_info(info)
-            # Build new row without excluded columns
-            new_row = {f: row.get(f, '') for f in base_fieldnames}
-            for cat in CATEGORIES:
-                new_row[cat] = parsed[cat]
-            rows.append(new_row)
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, 'w', newline='', encoding='utf-8') as outf:
-        writer = csv.DictWriter(outf, fieldnames=new_fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+        # parse_info is CPU-bound and independent per row, so batches of rows are
+        # parsed across PARSE_WORKERS processes (in-process on a single core) and
+        # written out in input order; OUTPUT_CSV is replaced at the end
+        pool = Pool(PARSE_WORKERS) if PARSE_WORKERS > 1 else contextlib.nullcontext()
+        with pool, atomic_csv_writer(output_path, new_fieldnames) as writer:
+            while batch := list(islice(reader, BATCH_ROWS)):
+                infos = (row.get(INFO_COL, '') for row in batch)
+                parsed_rows = pool.imap(parse_info, infos, CHUNKSIZE) if PARSE_WORKERS > 1 else map(parse_info, infos)
+                for row, parsed in zip(batch, parsed_rows):
+                    # Build new row without excluded columns, positionally in new_fieldnames order
+                    new_row = [row.get(f, '') for f in base_fieldnames]
+                    new_row.extend(parsed[cat] for cat in CATEGORIES)
+                    writer.writerow(new_row)
     print(f'Parsed CSV written to {OUTPUT_CSV}')
 
 if __name__ == '__main__':